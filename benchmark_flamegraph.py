@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""Benchmarks flamegraph.py on synthetic spindump reports.
+
+Every pipeline phase is timed separately and results are written as JSON,
+so they can be compared between revisions, e.g.
+
+python benchmark_flamegraph.py --lines 1000 100000 --output before.json
+"""
+
+from __future__ import unicode_literals
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import flamegraph
+
+
+_REPORT_HEADER = """Date/Time:       2013-08-30 20:32:27 +0300
+OS Version:      Mac OS X 10.8.4 (Build 12E55)
+
+Hardware model:  Macmini6,2
+
+Duration:        10.00s
+
+Fan speed:       1796 rpm
+
+Command:         Synthetic
+PID:             1000
+
+"""
+
+
+def generate_spindump(stream, line_count, thread_count=8, max_depth=64, fan_out=4,
+                      symbol_count=1000, seed=0):
+    """Writes synthetic report with about line_count frame lines to a text stream.
+
+    Frame lines are split evenly between thread_count threads.  Every frame
+    has from 1 to fan_out children, stacks are at most max_depth frames deep,
+    so small max_depth and fan_out can limit threads to fewer lines.  Frame
+    names are picked from symbol_count distinct symbols."""
+    rng = random.Random(seed)
+    symbols = ["function_%d + %d (Library%d) [0x%x]" % (i, rng.randint(1, 4000), i % 50, rng.getrandbits(44))
+               for i in range(symbol_count)]
+    stream.write(_REPORT_HEADER)
+    lines_per_thread = max(1, line_count // thread_count)
+    for thread_number in range(thread_count):
+        root_sample_count = max(lines_per_thread, 1000)
+        stream.write("  Thread 0x%x     %d samples (1-%d)\n" % (
+            0x1000 + thread_number, root_sample_count, root_sample_count))
+        written_lines = 0
+        stack = [(0, root_sample_count)]
+        while len(stack) > 0 and written_lines < lines_per_thread:
+            depth, sample_count = stack.pop()
+            stream.write("  " * (depth + 1))
+            stream.write("%d %s\n" % (sample_count, symbols[rng.randrange(symbol_count)]))
+            written_lines += 1
+            if depth + 1 >= max_depth:
+                continue
+            child_count = min(rng.randint(1, fan_out), sample_count)
+            # Split samples between children, some of them stay as self samples.
+            remaining_sample_count = sample_count
+            child_sample_counts = []
+            for child_number in range(child_count):
+                child_sample_count = rng.randint(1, remaining_sample_count - (child_count - child_number - 1))
+                child_sample_counts.append(child_sample_count)
+                remaining_sample_count -= child_sample_count
+            stack.extend((depth + 1, child_sample_count) for child_sample_count in reversed(child_sample_counts))
+        stream.write("\n")
+    stream.write("  Binary Images:\n")
+    stream.write("         0x10d19a000 -        0x10d19afff  com.example.Synthetic 1.0 /Synthetic\n")
+
+
+class _NullStream:
+    """Discards written strings, but counts their length."""
+    def __init__(self):
+        self.length = 0
+
+    def write(self, unicode_str):
+        self.length += len(unicode_str)
+
+
+class _Phase:
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+
+    def __enter__(self):
+        gc.collect()
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self.start_time
+        self.peak_bytes = None
+        if self.trace_memory:
+            _, self.peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        return False
+
+    def result(self, item_count, item_name):
+        return {"seconds": self.seconds,
+                item_name: item_count,
+                item_name + "_per_second": item_count / self.seconds if self.seconds > 0 else None,
+                "peak_bytes": self.peak_bytes}
+
+
+def run_benchmark(path, line_count, settings, trace_memory=False):
+    """Returns timings of pipeline phases for report at path."""
+    phases = {}
+    with _Phase(trace_memory) as phase:
+        # The same parser as command line uses.
+        report = flamegraph.TraceReport.from_file(path)
+    threads = report.process_trace.threads
+    phases["parse"] = phase.result(line_count, "lines")
+    node_count = sum(len(thread.frame_tree) for thread in threads)
+
+    with _Phase(trace_memory) as phase:
+        visible_frames = []
+        for thread in threads:
+            frame_tree = thread.frame_tree
+            frame_tree.compute_layout()
+            width_per_sample = float(settings.total_width) / frame_tree.sample_counts[0]
+            visible_frames.append(list(flamegraph.iter_visible_frames(
+                frame_tree, settings.min_frame_width / width_per_sample, settings.merge_narrow_frames)))
+    phases["layout"] = phase.result(node_count, "nodes")
+    visible_count = sum(len(frames) for frames in visible_frames)
+
+    with _Phase(trace_memory) as phase:
+        colors = []
+        for thread, frames in zip(threads, visible_frames):
+            width_per_sample = float(settings.total_width) / thread.frame_tree.sample_counts[0]
+            max_stack_depth = thread.max_stack_depth()
+            colors.append(settings.color_interpolator.rgb_strings_at_positions(
+                (start * width_per_sample / settings.total_width, float(depth) / max_stack_depth)
+                for _, start, depth, _ in frames))
+    phases["color"] = phase.result(visible_count, "frames")
+
+    null_stream = _NullStream()
+    with _Phase(trace_memory) as phase:
+        for thread, frames, thread_colors in zip(threads, visible_frames, colors):
+            frame_tree = thread.frame_tree
+            width_per_sample = float(settings.total_width) / frame_tree.sample_counts[0]
+            height = flamegraph.thread_trace_height(thread, settings)
+            svg = flamegraph.StreamingSVG(null_stream, settings.total_width, height)
+            text_fitter = flamegraph.TextFitter()
+            for (index, start, depth, sample_count), color in zip(frames, thread_colors):
+                x = start * width_per_sample
+                y = height - depth * settings.sample_height
+                width = sample_count * width_per_sample
+                svg.add_rect(x, y - settings.sample_height, width, settings.sample_height - 1., color)
+                svg.add_bounded_text(frame_tree.frame(index), x + 2., y - 4., width - 2.,
+                                     text_fitter, frame_tree.frame_ids[index])
+            svg.close()
+    phases["svg"] = phase.result(visible_count, "frames")
+    phases["svg"]["output_characters"] = null_stream.length
+
+    with _Phase(trace_memory) as phase:
+        for thread in threads:
+            flamegraph.write_thread_trace(_NullStream(), thread, settings)
+    phases["render"] = phase.result(visible_count, "frames")
+    return {"lines": line_count, "threads": len(threads), "nodes": node_count,
+            "visible_frames": visible_count, "phases": phases}
+
+
+def _revision():
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.STDOUT)
+        return output.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks flamegraph.py on synthetic spindump reports.")
+    parser.add_argument("--lines", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="report sizes in frame lines (default: 1000 10000 100000)")
+    parser.add_argument("--threads", type=int, default=8, help="threads per report")
+    parser.add_argument("--max-depth", type=int, default=64, help="maximum stack depth")
+    parser.add_argument("--fan-out", type=int, default=4, help="maximum number of children per frame")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of generated reports")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="measure peak memory of every phase with tracemalloc, slows phases down")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main():
+    arguments = parse_arguments(sys.argv[1:])
+    settings = flamegraph.FlameGraphSettings()
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        for line_count in arguments.lines:
+            path = os.path.join(directory, "synthetic-%d.spin" % line_count)
+            with io.open(path, "wt") as report_file:
+                generate_spindump(report_file, line_count, arguments.threads, arguments.max_depth,
+                                  arguments.fan_out, seed=arguments.seed)
+            results.append(run_benchmark(path, line_count, settings, arguments.trace_memory))
+            os.remove(path)
+    finally:
+        shutil.rmtree(directory)
+    output = {"revision": _revision(),
+              "python": platform.python_version(),
+              "parameters": {"threads": arguments.threads, "max_depth": arguments.max_depth,
+                             "fan_out": arguments.fan_out, "seed": arguments.seed},
+              "results": results}
+    if arguments.output:
+        with io.open(arguments.output, "wt") as output_file:
+            output_file.write(json.dumps(output, indent=2, sort_keys=True))
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -1,110 +1,1309 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 from __future__ import unicode_literals
+import argparse
+import bisect
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import glob
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import lzma
+import mmap
 import operator
+import os
 import random
 import re
+import struct
 import sys
+import threading
+import time
+from array import array
+from functools import reduce
 from xml.sax import saxutils
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory isn't reported there.
+    resource = None
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+# Instrumentation.
+class _NullStage:
+    """Stage of disabled instrumentation, does nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def count(self, name, value):
+        pass
+
+
+class NullInstrumentation:
+    """Instrumentation which records nothing, used by default."""
+    _STAGE = _NullStage()
+
+    def stage(self, name):
+        return self._STAGE
+
+
+class _Stage:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.counts = {}
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation._finish_stage(self.name, time.perf_counter() - self.start_time, self.counts)
+        return False
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+class Instrumentation:
+    """Records wall time, element counts and peak RSS of pipeline stages.
+
+    Stages with the same name are accumulated.  Callbacks are called after
+    every stage with stage name, duration in seconds and counts dictionary.
+    Install instrumentation with set_instrumentation().  Only stages of the
+    current process are recorded, not those running in worker processes."""
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.callbacks = []
+
+    def stage(self, name):
+        """Returns context manager which measures the stage, use its count() to add counts."""
+        return _Stage(self, name)
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def _finish_stage(self, name, seconds, counts):
+        record = self.stages.get(name)
+        if record is None:
+            record = self.stages[name] = {"calls": 0, "seconds": 0., "counts": {}}
+        record["calls"] += 1
+        record["seconds"] += seconds
+        for count_name, value in counts.items():
+            record["counts"][count_name] = record["counts"].get(count_name, 0) + value
+        record["peak_rss_bytes"] = peak_rss_bytes()
+        for callback in self.callbacks:
+            callback(name, seconds, counts)
+
+    def write_json(self, stream):
+        stream.write(json.dumps(self.stages, indent=2))
+        stream.write("\n")
+
 
+def peak_rss_bytes():
+    """Returns peak resident set size of current process or None if unknown."""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, Mac OS X reports bytes.
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+_instrumentation = NullInstrumentation()
+
+
+def set_instrumentation(instrumentation):
+    """Installs instrumentation for all pipeline stages, returns previous one.
+
+    Pass NullInstrumentation() to disable it."""
+    global _instrumentation
+    previous_instrumentation = _instrumentation
+    _instrumentation = instrumentation
+    return previous_instrumentation
+
+
+class SymbolTable:
+    """Interns frame names into integer ids.
+
+    A single table can be shared by many frame trees, e.g. by all threads of a
+    process, so every distinct name is stored once and frames of different
+    trees can be compared by id."""
+    def __init__(self):
+        self.names = []
+        self._ids_by_name = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, name):
+        """Returns id of name, adds the name if necessary."""
+        symbol_id = self._ids_by_name.get(name)
+        if symbol_id is None:
+            symbol_id = len(self.names)
+            self.names.append(name)
+            self._ids_by_name[name] = symbol_id
+        return symbol_id
+
+    def find(self, name):
+        """Returns id of name or None if name isn't interned."""
+        return self._ids_by_name.get(name)
+
+    def name(self, symbol_id):
+        return self.names[symbol_id]
+
+
+class FrameTree:
+    """Stores frame samples of a thread as parallel arrays (struct of arrays).
+
+    Node i is described by parents[i], depths[i], starts[i], sample_counts[i]
+    and frame_ids[i].  Frame names are interned, frame_ids[i] is an id in
+    symbols.  Children are linked through first_children and next_siblings,
+    missing nodes are denoted by -1.  Node 0 is the root, except in trees
+    linked together through FrameSample.add_child_sample.
+
+    heights[i] is distance from node to the most distant leaf in its subtree.
+    It is propagated to the parent when node is finished, i.e. all its children
+    are added (see finish_node)."""
+    COLUMN_NAMES = ("parents", "first_children", "last_children", "next_siblings",
+                    "depths", "starts", "sample_counts", "frame_ids", "heights")
+    # (tree, index offset) after all nodes were moved to another tree, see absorb.
+    moved_to = None
+
+    def __init__(self, symbols=None):
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        self.parents = array("i")
+        self.first_children = array("i")
+        self.last_children = array("i")
+        self.next_siblings = array("i")
+        self.depths = array("i")
+        self.starts = array("l")
+        self.sample_counts = array("l")
+        self.frame_ids = array("i")
+        self.heights = array("i")
+
+    def __len__(self):
+        return len(self.parents)
+
+    def frame(self, index):
+        return self.symbols.names[self.frame_ids[index]]
+
+    def add_node(self, parent, frame, sample_count):
+        """Adds node as the last child of parent (-1 for root), returns its index.
+
+        Start offset and depth are computed from already added nodes."""
+        return self.add_node_by_id(parent, self.symbols.intern(frame), sample_count)
+
+    def add_node_by_id(self, parent, frame_id, sample_count):
+        """Same as add_node, but frame is specified by id in symbols."""
+        index = len(self.parents)
+        if parent < 0:
+            depth = 0
+            start = 0
+        else:
+            depth = self.depths[parent] + 1
+            last_child = self.last_children[parent]
+            if last_child < 0:
+                start = self.starts[parent]
+                self.first_children[parent] = index
+            else:
+                start = self.starts[last_child] + self.sample_counts[last_child]
+                self.next_siblings[last_child] = index
+            self.last_children[parent] = index
+        self.parents.append(parent)
+        self.first_children.append(-1)
+        self.last_children.append(-1)
+        self.next_siblings.append(-1)
+        self.depths.append(depth)
+        self.starts.append(start)
+        self.sample_counts.append(sample_count)
+        self.frame_ids.append(frame_id)
+        self.heights.append(1)
+        return index
+
+    def extend_preorder(self, nodes):
+        """Adds nodes of an empty tree from (depth, frame_id, sample_count) in preorder, root has depth 0.
+
+        Same as add_node_by_id and finish_node for every node, but columns are
+        filled in a single loop without per-node method calls."""
+        assert len(self) == 0
+        parents = self.parents
+        first_children = self.first_children
+        last_children = self.last_children
+        next_siblings = self.next_siblings
+        starts = self.starts
+        sample_counts = self.sample_counts
+        heights = self.heights
+        depths_append = self.depths.append
+        frame_ids_append = self.frame_ids.append
+        index = 0
+        stack = []
+        for depth, frame_id, sample_count in nodes:
+            # Shorten stack to node's parent, popped nodes are complete.
+            while len(stack) > depth:
+                finished = stack.pop()
+                parent = parents[finished]
+                if parent >= 0 and heights[parent] <= heights[finished]:
+                    heights[parent] = heights[finished] + 1
+            if len(stack) > 0:
+                parent = stack[-1]
+                last_child = last_children[parent]
+                if last_child < 0:
+                    start = starts[parent]
+                    first_children[parent] = index
+                else:
+                    start = starts[last_child] + sample_counts[last_child]
+                    next_siblings[last_child] = index
+                last_children[parent] = index
+            else:
+                assert index == 0, "Tree can have only one root"
+                parent = -1
+                start = 0
+            parents.append(parent)
+            first_children.append(-1)
+            last_children.append(-1)
+            next_siblings.append(-1)
+            depths_append(len(stack))
+            starts.append(start)
+            sample_counts.append(sample_count)
+            frame_ids_append(frame_id)
+            heights.append(1)
+            stack.append(index)
+            index += 1
+        while len(stack) > 0:
+            finished = stack.pop()
+            parent = parents[finished]
+            if parent >= 0 and heights[parent] <= heights[finished]:
+                heights[parent] = heights[finished] + 1
+
+    def finish_node(self, index):
+        """Propagates height of node to its parent, call after all children are finished."""
+        parent = self.parents[index]
+        if parent >= 0 and self.heights[parent] <= self.heights[index]:
+            self.heights[parent] = self.heights[index] + 1
+
+    def _update_ancestor_heights(self, index):
+        parent = self.parents[index]
+        while parent >= 0 and self.heights[parent] <= self.heights[index]:
+            self.heights[parent] = self.heights[index] + 1
+            index = parent
+            parent = self.parents[index]
+
+    def children(self, index):
+        """Yields indices of node children in order."""
+        child = self.first_children[index]
+        while child >= 0:
+            yield child
+            child = self.next_siblings[child]
+
+    def iter_subtree(self, index):
+        """Yields indices of all nodes in subtree, parent before its children."""
+        stack = [index]
+        while len(stack) > 0:
+            index = stack.pop()
+            yield index
+            stack.extend(reversed(list(self.children(index))))
+
+    def height(self, index):
+        """Returns distance from node to the most distant leaf node, 1 for leaf."""
+        return self.heights[index]
+
+    def graft(self, parent, other_tree, other_index):
+        """Copies subtree of other_tree as the last child of parent, returns index of the copy."""
+        copy_index = None
+        same_symbols = other_tree.symbols is self.symbols
+        stack = [(other_index, parent)]
+        while len(stack) > 0:
+            index, new_parent = stack.pop()
+            if same_symbols:
+                frame_id = other_tree.frame_ids[index]
+            else:
+                frame_id = self.symbols.intern(other_tree.frame(index))
+            new_index = self.add_node_by_id(new_parent, frame_id, other_tree.sample_counts[index])
+            self.heights[new_index] = other_tree.heights[index]
+            if copy_index is None:
+                copy_index = new_index
+            stack.extend((child, new_index) for child in reversed(list(other_tree.children(index))))
+        self._update_ancestor_heights(copy_index)
+        return copy_index
+
+    def absorb(self, other_tree):
+        """Appends all nodes of other_tree, returns offset added to their indices.
+
+        other_tree is emptied and views of its nodes (see FrameSample) are
+        redirected to the appended nodes."""
+        offset = len(self)
+        for column_name in ("parents", "first_children", "last_children", "next_siblings"):
+            getattr(self, column_name).extend(
+                index + offset if index >= 0 else -1 for index in getattr(other_tree, column_name))
+        for column_name in ("depths", "starts", "sample_counts", "heights"):
+            getattr(self, column_name).extend(getattr(other_tree, column_name))
+        if other_tree.symbols is self.symbols:
+            self.frame_ids.extend(other_tree.frame_ids)
+        else:
+            self.frame_ids.extend(self.symbols.intern(other_tree.frame(index)) for index in range(len(other_tree)))
+        for column_name in self.COLUMN_NAMES:
+            setattr(other_tree, column_name, array(getattr(other_tree, column_name).typecode))
+        other_tree.moved_to = (self, offset)
+        return offset
+
+    def attach(self, parent, index):
+        """Makes root node index the last child of parent without copying its subtree.
+
+        Depths and starts in the attached subtree aren't updated, see
+        compute_layout."""
+        assert self.parents[index] < 0, "Node already has a parent"
+        self.parents[index] = parent
+        last_child = self.last_children[parent]
+        if last_child < 0:
+            self.first_children[parent] = index
+        else:
+            self.next_siblings[last_child] = index
+        self.last_children[parent] = index
+        self._update_ancestor_heights(index)
+
+    def sample(self, index):
+        return FrameSample.view(self, index)
+
+    def find_path(self, frames, index=0):
+        """Returns descendant of index reached through child frames with given names, -1 if there is none."""
+        for frame in frames:
+            frame_id = self.symbols.find(frame)
+            index = next((child for child in self.children(index) if self.frame_ids[child] == frame_id), -1)
+            if index < 0:
+                break
+        return index
+
+    def with_own_symbols(self):
+        """Returns copy of tree with a new symbol table which has only frames of this tree.
+
+        A tree sharing a big symbol table, e.g. with other threads, is much
+        cheaper to send to another process this way."""
+        symbols = SymbolTable()
+        frame_tree = FrameTree(symbols)
+        for column_name in self.COLUMN_NAMES:
+            setattr(frame_tree, column_name, getattr(self, column_name)[:])
+        names = self.symbols.names
+        translated_ids = {}
+        frame_ids = frame_tree.frame_ids
+        for index in range(len(frame_ids)):
+            frame_id = frame_ids[index]
+            translated_id = translated_ids.get(frame_id)
+            if translated_id is None:
+                translated_id = translated_ids[frame_id] = symbols.intern(names[frame_id])
+            frame_ids[index] = translated_id
+        return frame_tree
+
+    def memory_size(self):
+        """Returns number of bytes used by columns, symbols aren't included."""
+        return sum(getattr(self, column_name).itemsize * len(self) for column_name in self.COLUMN_NAMES)
+
+    def compute_layout(self):
+        """Recomputes depths, starts and heights of all nodes in one pass.
+
+        Needed when sample counts were changed after children were added."""
+        if len(self) == 0:
+            return
+        self.depths[0] = 0
+        self.starts[0] = 0
+        # Parents are visited before children, heights are propagated back in reverse order.
+        visit_order = []
+        stack = [0]
+        while len(stack) > 0:
+            index = stack.pop()
+            visit_order.append(index)
+            self.heights[index] = 1
+            child_depth = self.depths[index] + 1
+            child_start = self.starts[index]
+            for child in self.children(index):
+                self.depths[child] = child_depth
+                self.starts[child] = child_start
+                child_start += self.sample_counts[child]
+                stack.append(child)
+        for index in reversed(visit_order):
+            self.finish_node(index)
+
+    def self_sample_count(self, index):
+        """Returns samples of node which aren't attributed to any child."""
+        return self.sample_counts[index] - sum(self.sample_counts[child] for child in self.children(index))
+
+    def iter_folded_stacks(self, prefix=None):
+        """Yields a line in folded format "root;child;leaf count" per stack with self samples.
+
+        Tree is traversed once, the current stack is kept as a list of names.
+        If prefix is provided, it is added as the outermost frame."""
+        if len(self) == 0:
+            return
+        # ";" separates frames in folded format.
+        names = {}
+        path = [] if prefix is None else [prefix.replace(";", ":")]
+        base_length = len(path)
+        stack = [0]
+        while len(stack) > 0:
+            index = stack.pop()
+            frame_id = self.frame_ids[index]
+            name = names.get(frame_id)
+            if name is None:
+                name = names[frame_id] = self.symbols.names[frame_id].replace(";", ":")
+            del path[base_length + self.depths[index]:]
+            path.append(name)
+            children = list(self.children(index))
+            self_sample_count = self.sample_counts[index] - sum(self.sample_counts[child] for child in children)
+            if self_sample_count > 0:
+                yield "{0} {1}".format(";".join(path), self_sample_count)
+            children.reverse()
+            stack.extend(children)
+
+    @classmethod
+    def from_folded(cls, lines, symbols=None, root_frame="all"):
+        """Builds tree from lines in folded format "root;child;leaf count".
+
+        Equal stack prefixes are merged.  If stacks have different outermost
+        frames, they are put under a new root named root_frame."""
+        tree = cls(symbols)
+        root = tree.add_node(-1, root_frame, 0)
+        child_index = _ChildIndex(tree)
+        for line in lines:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            stack, _, sample_count = line.rpartition(" ")
+            sample_count = int(sample_count)
+            index = root
+            tree.sample_counts[root] += sample_count
+            for frame in stack.split(";"):
+                child = child_index.child(index, tree.symbols.intern(frame))
+                tree.sample_counts[child] += sample_count
+                index = child
+        tree.compute_layout()
+        root_children = list(tree.children(root))
+        if len(root_children) == 1:
+            single_root_tree = cls(tree.symbols)
+            single_root_tree.graft(-1, tree, root_children[0])
+            return single_root_tree
+        return tree
+
+
+class _ChildIndex:
+    """Finds child of a node by frame in a tree being built, adds missing children.
+
+    Children are found through a hash map keyed by (parent index, frame id)
+    instead of scanning siblings, so building a tree from stacks or other
+    trees is linear in the total number of nodes."""
+    def __init__(self, tree):
+        self.tree = tree
+        self._children = {}
+
+    def child(self, parent, frame_id):
+        """Returns index of child of parent with frame_id, adds it with no samples if it is missing."""
+        key = (parent, frame_id)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self.tree.add_node_by_id(parent, frame_id, 0)
+        return child
+
+
+class FrameTreeMerger:
+    """Merges frame trees by frame path, summing sample counts of equal paths.
+
+    Merging is linear in the total number of nodes.  All merged trees are put
+    under a common root."""
+    def __init__(self, symbols=None, root_frame="all"):
+        self.tree = FrameTree(symbols)
+        self.root = self.tree.add_node(-1, root_frame, 0)
+        self._child_index = _ChildIndex(self.tree)
+
+    def add(self, frame_tree, index=0, parent=None):
+        """Merges subtree of frame_tree as a child of merged node parent, root by default.
+
+        Sample counts of parent and its ancestors are increased accordingly.
+        Returns mapping from indices in frame_tree to merged indices, -1 for
+        nodes outside of subtree."""
+        if parent is None:
+            parent = self.root
+        ancestor = parent
+        while ancestor >= 0:
+            self.tree.sample_counts[ancestor] += frame_tree.sample_counts[index]
+            ancestor = self.tree.parents[ancestor]
+        frame_ids = self._frame_id_translation(frame_tree)
+        merged_index = self._child_index.child(parent, frame_ids(frame_tree.frame_ids[index]))
+        return self._merge(frame_tree, index, merged_index, frame_ids)
+
+    def add_into(self, frame_tree, index, merged_index):
+        """Merges node of frame_tree into existing merged node, i.e. they are treated as the same frame.
+
+        Useful to merge a tree which has been merged before, e.g. add_into(tree, 0, merger.root)."""
+        return self._merge(frame_tree, index, merged_index, self._frame_id_translation(frame_tree))
+
+    def finish(self):
+        """Computes layout of merged tree and returns it."""
+        self.tree.compute_layout()
+        return self.tree
+
+    def _frame_id_translation(self, frame_tree):
+        if frame_tree.symbols is self.tree.symbols:
+            return lambda frame_id: frame_id
+        translated_ids = {}
+        def translate(frame_id):
+            translated_id = translated_ids.get(frame_id)
+            if translated_id is None:
+                translated_id = translated_ids[frame_id] = self.tree.symbols.intern(frame_tree.symbols.names[frame_id])
+            return translated_id
+        return translate
+
+    def _merge(self, frame_tree, index, merged_index, frame_ids):
+        mapping = array("i", [-1]) * len(frame_tree)
+        merged_sample_counts = self.tree.sample_counts
+        merged_child_of = self._child_index.child
+        stack = [(index, merged_index)]
+        while len(stack) > 0:
+            index, merged_index = stack.pop()
+            mapping[index] = merged_index
+            merged_sample_counts[merged_index] += frame_tree.sample_counts[index]
+            for child in frame_tree.children(index):
+                stack.append((child, merged_child_of(merged_index, frame_ids(frame_tree.frame_ids[child]))))
+        return mapping
+
+
+def merge_frame_trees(frame_trees, symbols=None, root_frame="all"):
+    """Returns a single tree with all frame_trees merged by frame path under root_frame."""
+    merger = FrameTreeMerger(symbols, root_frame)
+    for frame_tree in frame_trees:
+        merger.add(frame_tree)
+    return merger.finish()
+
+
+_FRAME_ADDRESS_RE = re.compile(r" \+ \d+| \[0x[0-9a-fA-F]+\]")
+
+
+def normalize_frame_tree(frame_tree, strip_addresses=True, collapse_recursion=False):
+    """Returns new tree where siblings with the same frame are merged and their sample counts summed.
+
+    If strip_addresses is set, offsets and addresses are removed from frame
+    names first, e.g. "main + 34 (Xcode) [0x10d19ae72]" becomes "main (Xcode)",
+    so different call sites of a function are merged too.  If
+    collapse_recursion is set, frames directly called by the same frame are
+    merged into their caller.  Every name is normalized once, so
+    normalization is linear."""
+    symbols = frame_tree.symbols
+    normalized_tree = FrameTree(symbols)
+    if len(frame_tree) == 0:
+        return normalized_tree
+    normalized_ids = {}
+    def normalize(frame_id):
+        normalized_id = normalized_ids.get(frame_id)
+        if normalized_id is None:
+            if strip_addresses:
+                normalized_id = symbols.intern(_FRAME_ADDRESS_RE.sub("", symbols.names[frame_id]))
+            else:
+                normalized_id = frame_id
+            normalized_ids[frame_id] = normalized_id
+        return normalized_id
+    frame_ids = frame_tree.frame_ids
+    sample_counts = frame_tree.sample_counts
+    normalized_frame_ids = normalized_tree.frame_ids
+    normalized_sample_counts = normalized_tree.sample_counts
+    normalized_child_of = _ChildIndex(normalized_tree).child
+    stack = [(0, normalized_tree.add_node_by_id(-1, normalize(frame_ids[0]), sample_counts[0]))]
+    while len(stack) > 0:
+        index, normalized_index = stack.pop()
+        children = []
+        for child in frame_tree.children(index):
+            frame_id = normalize(frame_ids[child])
+            if collapse_recursion and frame_id == normalized_frame_ids[normalized_index]:
+                # Samples of recursive call are already counted by its caller.
+                children.append((child, normalized_index))
+                continue
+            normalized_child = normalized_child_of(normalized_index, frame_id)
+            normalized_sample_counts[normalized_child] += sample_counts[child]
+            children.append((child, normalized_child))
+        # Keep order of children for nodes merged later.
+        children.reverse()
+        stack.extend(children)
+    normalized_tree.compute_layout()
+    return normalized_tree
+
+
+def invert_frame_tree(frame_tree, root_frame="all"):
+    """Returns callers tree: root_frame, frames with self samples above it, their callers above them, etc.
+
+    Every node with self samples adds them to the path of its ancestors,
+    which is followed through parents column, so stacks are never copied.
+    Equal paths are merged."""
+    inverted_tree = FrameTree(frame_tree.symbols)
+    root = inverted_tree.add_node(-1, root_frame, 0)
+    if len(frame_tree) == 0:
+        return inverted_tree
+    parents = frame_tree.parents
+    frame_ids = frame_tree.frame_ids
+    inverted_sample_counts = inverted_tree.sample_counts
+    inverted_child_of = _ChildIndex(inverted_tree).child
+    for index in frame_tree.iter_subtree(0):
+        self_sample_count = frame_tree.self_sample_count(index)
+        if self_sample_count <= 0:
+            continue
+        inverted_sample_counts[root] += self_sample_count
+        inverted_index = root
+        caller = index
+        while caller >= 0:
+            inverted_child = inverted_child_of(inverted_index, frame_ids[caller])
+            inverted_sample_counts[inverted_child] += self_sample_count
+            inverted_index = inverted_child
+            caller = parents[caller]
+    inverted_tree.compute_layout()
+    return inverted_tree
+
+
+def diff_frame_trees(before_tree, after_tree):
+    """Returns sample count deltas from before_tree to after_tree, one per node of after_tree.
+
+    Nodes are joined by frame path, roots are joined regardless of their
+    frames.  Nodes of after_tree are indexed by (parent index, frame id), so
+    every node of before_tree is found with a single lookup and the join is
+    linear.  Paths present only in before_tree are ignored."""
+    deltas = array("i", after_tree.sample_counts)
+    if len(before_tree) == 0 or len(after_tree) == 0:
+        return deltas
+    after_nodes = {}
+    after_parents = after_tree.parents
+    after_frame_ids = after_tree.frame_ids
+    for index in range(1, len(after_tree)):
+        after_nodes[(after_parents[index], after_frame_ids[index])] = index
+    if before_tree.symbols is after_tree.symbols:
+        frame_ids = lambda frame_id: frame_id
+    else:
+        frame_ids = lambda frame_id: after_tree.symbols.find(before_tree.symbols.names[frame_id])
+    before_frame_ids = before_tree.frame_ids
+    before_sample_counts = before_tree.sample_counts
+    stack = [(0, 0)]
+    while len(stack) > 0:
+        before_index, after_index = stack.pop()
+        deltas[after_index] -= before_sample_counts[before_index]
+        for child in before_tree.children(before_index):
+            after_child = after_nodes.get((after_index, frame_ids(before_frame_ids[child])))
+            if after_child is not None:
+                stack.append((child, after_child))
+    return deltas
+
+
+class FrameIndex:
+    """Self and inclusive samples of every distinct frame and inverted index from frames to nodes.
+
+    Built in a single preorder traversal of every tree, afterwards queries
+    don't walk trees.  Inclusive samples of recursive frames are counted once
+    per stack: nodes with the same frame higher on the stack aren't added.
+    All frame_trees must share a symbol table."""
+    def __init__(self, frame_trees):
+        self.frame_trees = list(frame_trees)
+        self.symbols = self.frame_trees[0].symbols if len(self.frame_trees) > 0 else SymbolTable()
+        self.self_sample_counts = collections.defaultdict(int)
+        self.inclusive_sample_counts = collections.defaultdict(int)
+        # Nodes of every frame, separately for every tree.
+        self.tree_nodes = []
+        for frame_tree in self.frame_trees:
+            assert frame_tree.symbols is self.symbols
+            self.tree_nodes.append(self._add_tree(frame_tree))
+
+    def _add_tree(self, frame_tree):
+        nodes = collections.defaultdict(lambda: array("i"))
+        if len(frame_tree) == 0:
+            return nodes
+        self_sample_counts = self.self_sample_counts
+        inclusive_sample_counts = self.inclusive_sample_counts
+        parents = frame_tree.parents
+        depths = frame_tree.depths
+        frame_ids = frame_tree.frame_ids
+        sample_counts = frame_tree.sample_counts
+        # Frames on the current stack and how many times each of them is there.
+        path = []
+        path_frame_counts = collections.defaultdict(int)
+        for index in frame_tree.iter_subtree(0):
+            while len(path) > depths[index]:
+                path_frame_counts[path.pop()] -= 1
+            frame_id = frame_ids[index]
+            sample_count = sample_counts[index]
+            nodes[frame_id].append(index)
+            self_sample_counts[frame_id] += sample_count
+            if parents[index] >= 0:
+                self_sample_counts[frame_ids[parents[index]]] -= sample_count
+            if path_frame_counts[frame_id] == 0:
+                inclusive_sample_counts[frame_id] += sample_count
+            path.append(frame_id)
+            path_frame_counts[frame_id] += 1
+        return nodes
+
+    def top(self, count, inclusive=False):
+        """Returns [(frame, sample_count)] for count frames with the most self or inclusive samples."""
+        sample_counts = self.inclusive_sample_counts if inclusive else self.self_sample_counts
+        return [(self.symbols.names[frame_id], sample_count) for frame_id, sample_count in
+                heapq.nlargest(count, sample_counts.items(), key=operator.itemgetter(1))]
+
+    def search(self, pattern):
+        """Returns ids of frames which names match regular expression pattern."""
+        regex = re.compile(pattern)
+        names = self.symbols.names
+        return set(frame_id for frame_id in self.inclusive_sample_counts if regex.search(names[frame_id]))
+
+    def nodes(self, frame_ids, tree_number=0):
+        """Returns sorted indices of nodes with given frame ids in a tree."""
+        tree_nodes = self.tree_nodes[tree_number]
+        return sorted(index for frame_id in frame_ids if frame_id in tree_nodes for index in tree_nodes[frame_id])
+
+    def matched_sample_count(self, frame_ids):
+        """Returns number of samples with any of frame_ids on stack, every sample is counted once."""
+        matched_sample_count = 0
+        for tree_number, frame_tree in enumerate(self.frame_trees):
+            # Subtrees are intervals of samples, count union of them.
+            covered_end = 0
+            # Merged and inverted trees add nodes out of layout order.
+            nodes = sorted(self.nodes(frame_ids, tree_number),
+                           key=lambda index: (frame_tree.starts[index], frame_tree.depths[index]))
+            for index in nodes:
+                start = frame_tree.starts[index]
+                end = start + frame_tree.sample_counts[index]
+                if end > covered_end:
+                    matched_sample_count += end - max(start, covered_end)
+                    covered_end = end
+        return matched_sample_count
+
+
+class FrameSample(object):
+    """Represents sampling results for a single frame within a thread trace.
+
+    It is a lightweight view of a node in FrameTree.  Constructing FrameSample
+    directly creates a new single-node tree, add_child_sample links such trees
+    together.  Views keep referring to the same node when its tree is moved."""
+    __slots__ = ("_tree", "_index")
 
-class FrameSample:
-    """Represents sampling results for a single frame within a thread trace."""
     def __init__(self, frame, sample_count):
-        self.frame = frame
-        self.sample_count = sample_count
-        self.child_samples = []
+        self._tree = FrameTree()
+        self._index = self._tree.add_node(-1, frame, sample_count)
+
+    @classmethod
+    def view(cls, tree, index):
+        frame_sample = cls.__new__(cls)
+        frame_sample._tree = tree
+        frame_sample._index = index
+        return frame_sample
+
+    def _follow_moves(self):
+        while self._tree.moved_to is not None:
+            self._tree, offset = self._tree.moved_to
+            self._index += offset
+
+    @property
+    def tree(self):
+        self._follow_moves()
+        return self._tree
+
+    @property
+    def index(self):
+        self._follow_moves()
+        return self._index
+
+    @property
+    def frame(self):
+        return self.tree.frame(self.index)
+
+    @property
+    def frame_id(self):
+        return self.tree.frame_ids[self.index]
+
+    @property
+    def sample_count(self):
+        return self.tree.sample_counts[self.index]
+
+    @property
+    def child_samples(self):
+        tree = self.tree
+        return [tree.sample(child) for child in tree.children(self.index)]
 
     def add_child_sample(self, child_sample):
-        self.child_samples.append(child_sample)
+        """Adds child_sample, which must not have a parent, as the last child.
+
+        Nodes aren't copied: the smaller of two trees is moved into the larger
+        one, so views of all nodes, including descendants of child_sample,
+        stay valid."""
+        tree = self.tree
+        child_tree = child_sample.tree
+        if child_tree is not tree:
+            if len(child_tree) > len(tree):
+                child_tree.absorb(tree)
+                tree = child_tree
+            else:
+                tree.absorb(child_tree)
+        tree.attach(self.index, child_sample.index)
 
     def height(self):
         """Returns distance from current node to the most distant leaf node.
 
         If self is leaf node returns 1."""
-        if len(self.child_samples) > 0:
-            child_heights = [child.height() for child in self.child_samples]
-            return max(child_heights) + 1
-        else:
-            return 1
+        return self.tree.height(self.index)
 
     def iteritems(self):
         """Iterates through all samples (first parent frame, then child frames).
 
         Yields frame itself, its start and depth."""
-        return self.__items_generator(0, 0)
-
-    def __items_generator(self, start, depth):
-        yield (self, start, depth)
-        child_start = start
-        for child_frame in self.child_samples:
-            for t in child_frame.__items_generator(child_start, depth + 1):
-                yield t
-            child_start += child_frame.sample_count
+        tree = self.tree
+        sample_counts = tree.sample_counts
+        stack = [(self.index, 0, 0)]
+        while len(stack) > 0:
+            index, start, depth = stack.pop()
+            yield (tree.sample(index), start, depth)
+            children = []
+            for child in tree.children(index):
+                children.append((child, start, depth + 1))
+                start += sample_counts[child]
+            children.reverse()
+            stack.extend(children)
 
 
 class ThreadTrace:
     _INDENTATION = 2
     _DIGIT_RE = re.compile(r"\d+")
-
-    def __init__(self, trace_lines):
-        self.description = trace_lines[0].strip()
-        self.root_frame = None
+    # Differential traces have sample count change for every node, see diff_reports.
+    sample_deltas = None
+    _frame_index = None
+
+    def __init__(self, trace_lines, symbols=None):
+        """Frame names are interned in symbols, new SymbolTable is used by default."""
+        with _instrumentation.stage("parse_thread") as stage:
+            self._parse(trace_lines, symbols)
+            stage.count("nodes", len(self.frame_tree))
+
+    def _parse(self, trace_lines, symbols):
+        trace_lines = iter(trace_lines)
+        self.description = next(trace_lines).strip()
+        frame_tree = FrameTree(symbols)
         stack = []
-        for trace_line in trace_lines[1:]:
+        for trace_line in trace_lines:
             digit_match = self._DIGIT_RE.search(trace_line)
             assert digit_match is not None
             indentation = digit_match.start()
             assert (indentation % self._INDENTATION) == 0, "Unexpected indentation in line %s" % trace_line
-            nested_level = indentation / self._INDENTATION
-            if len(stack) >= nested_level:
-                # Shorten stack to appropriate level
-                stack = stack[:nested_level - 1]
+            nested_level = indentation // self._INDENTATION
+            # Shorten stack to appropriate level, popped frames are complete.
+            while len(stack) >= nested_level:
+                frame_tree.finish_node(stack.pop())
             sample_count = int(trace_line[digit_match.start():digit_match.end()])
             frame = trace_line[digit_match.end() + 1:]
-            frame_sample = FrameSample(frame, sample_count)
             if len(stack) > 0:
-                stack[-1].add_child_sample(frame_sample)
+                parent = stack[-1]
             else:
-                assert self.root_frame is None
-                self.root_frame = frame_sample
-            stack.append(frame_sample)
+                assert len(frame_tree) == 0
+                parent = -1
+            stack.append(frame_tree.add_node(parent, frame, sample_count))
+        while len(stack) > 0:
+            frame_tree.finish_node(stack.pop())
+        self.frame_tree = frame_tree
+        self.root_frame = frame_tree.sample(0) if len(frame_tree) > 0 else None
+
+    @classmethod
+    def from_frame_tree(cls, description, frame_tree):
+        thread_trace = cls.__new__(cls)
+        thread_trace.description = description
+        thread_trace.frame_tree = frame_tree
+        thread_trace.root_frame = frame_tree.sample(0) if len(frame_tree) > 0 else None
+        return thread_trace
+
+    @classmethod
+    def from_folded(cls, lines, description, symbols=None):
+        """Creates thread trace from lines in folded format, see FrameTree.from_folded."""
+        return cls.from_frame_tree(description, FrameTree.from_folded(lines, symbols))
+
+    def write_folded(self, stream, prefix=None):
+        """Writes stacks in folded format, one per line."""
+        for line in self.frame_tree.iter_folded_stacks(prefix):
+            stream.write(line)
+            stream.write("\n")
 
     def max_stack_depth(self):
-        return self.root_frame.height()
+        """Returns precomputed height of the root frame."""
+        return self.frame_tree.heights[0]
+
+    def with_own_symbols(self):
+        """Returns copy of thread trace with its own symbol table, see FrameTree.with_own_symbols."""
+        thread_trace = ThreadTrace.from_frame_tree(self.description, self.frame_tree.with_own_symbols())
+        thread_trace.sample_deltas = self.sample_deltas
+        return thread_trace
+
+    def normalized(self, strip_addresses=True, collapse_recursion=False):
+        """Returns ThreadTrace with normalized frame tree, see normalize_frame_tree."""
+        with _instrumentation.stage("normalize") as stage:
+            frame_tree = normalize_frame_tree(self.frame_tree, strip_addresses, collapse_recursion)
+            stage.count("nodes", len(self.frame_tree))
+            stage.count("normalized_nodes", len(frame_tree))
+        return ThreadTrace.from_frame_tree(self.description, frame_tree)
+
+    def inverted(self):
+        """Returns ThreadTrace with callers tree, see invert_frame_tree."""
+        with _instrumentation.stage("invert") as stage:
+            frame_tree = invert_frame_tree(self.frame_tree)
+            stage.count("nodes", len(self.frame_tree))
+            stage.count("inverted_nodes", len(frame_tree))
+        return ThreadTrace.from_frame_tree(self.description, frame_tree)
+
+    def frame_index(self):
+        """Returns FrameIndex of the thread, it is built once."""
+        if self._frame_index is None:
+            self._frame_index = FrameIndex([self.frame_tree])
+        return self._frame_index
 
 
 class ProcessTrace:
     """Represents trace of entire process, consists of a several thread traces."""
-    def __init__(self, attributes, process_sections):
-        """Attributes are name, path, etc.  Sections are thread traces or binary images."""
+    def __init__(self, attributes, process_sections, symbols=None):
+        """Attributes are name, path, etc.  Sections are thread traces or binary images.
+
+        Sections can be produced lazily, only a single section is needed at a time.
+        All threads share symbols, new SymbolTable is used by default."""
         self.attributes = attributes
+        self.symbols = symbols if symbols is not None else SymbolTable()
         self.threads = []
         for process_section in process_sections:
-            if process_section[0].lstrip().startswith("Thread"):
-                self.threads.append(ThreadTrace(process_section))
+            if is_thread_section(process_section):
+                self.threads.append(ThreadTrace(process_section, self.symbols))
             # Throw away everything else, e.g. binary images.
 
+    def frame_index(self):
+        """Returns FrameIndex of all threads, tree numbers are thread numbers."""
+        return FrameIndex(thread.frame_tree for thread in self.threads)
 
-class TraceReport:
-    def __init__(self, lines):
+    @classmethod
+    def from_thread_traces(cls, attributes, thread_traces, symbols):
+        process_trace = cls(attributes, [], symbols)
+        process_trace.threads.extend(thread_traces)
+        return process_trace
+
+
+class TraceReportParser:
+    """Parses report incrementally, section by section.
+
+    Lines can be any iterable, e.g. a file object, so the whole report isn't
+    kept in memory.  Parse time is linear in report size."""
+    def __init__(self, lines, symbols=None):
+        """All threads share symbols, new SymbolTable is used by default."""
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        self._sections = iter_sections(lines)
         # Parse general report header (4 sections)
         self.report_attributes = []
         for _ in range(4):
-            section, lines = take_until_empty_line(lines)
-            section_attributes = split_on_colon(section)
-            self.report_attributes.append(section_attributes)
-        # Parse process.
-        process_section, lines = take_until_empty_line(lines)
-        process_attributes = split_on_colon(process_section)
-        process_sections = []
-        while (lines is not None) and lines[0].startswith(" "):
-            process_section, lines = take_until_empty_line(lines)
-            process_sections.append(process_section)
-        self.process_trace = ProcessTrace(process_attributes, process_sections)
+            section = self._next_section()
+            self.report_attributes.append(split_on_colon(section))
+        # Parse process header.
+        self.process_attributes = split_on_colon(self._next_section())
+
+    def _next_section(self):
+        section = next(self._sections, None)
+        assert section is not None, "Unexpected end of report"
+        return section
+
+    def iter_process_sections(self):
+        """Yields process sections (thread traces, binary images) as soon as they are read."""
+        while True:
+            with _instrumentation.stage("split_sections") as stage:
+                section = next(self._sections, None)
+                stage.count("lines", len(section) if section is not None else 0)
+            if section is None:
+                break
+            if not section[0].startswith(" "):
+                # Process sections are indented, everything else isn't part of process.
+                break
+            yield section
+
+    def iter_thread_traces(self):
+        """Yields ThreadTrace for every thread section as soon as it is read."""
+        for section in self.iter_process_sections():
+            if is_thread_section(section):
+                yield ThreadTrace(section, self.symbols)
+
+    def iter_thread_sections(self):
+        """Yields unparsed thread sections, so threads can be parsed in other processes."""
+        for section in self.iter_process_sections():
+            if is_thread_section(section):
+                yield section
+
+    def process_trace(self):
+        return ProcessTrace(self.process_attributes, self.iter_process_sections(), self.symbols)
+
+
+class MappedTraceReportParser:
+    """Parses report in a bytes-like buffer, e.g. a memory-mapped file.
+
+    Sections are found by a regular expression over raw bytes and frame
+    lines are scanned one at a time, so only the name bytes of the current
+    line are copied.  Names are decoded once per distinct name.  Has the same
+    interface as TraceReportParser, except that iter_process_sections isn't
+    available."""
+    # Empty lines between sections, a pattern matching sections themselves would keep state for every line.
+    _SECTION_SEPARATOR_RE = re.compile(br"\n(?:\r?\n)+")
+    # Common frame lines, any other line, e.g. kernel frame "   *3 ...", is parsed like ThreadTrace does.
+    _FRAME_LINE_RE = re.compile(br"( *)(\d+) ([^\r\n]*)")
+    _DIGIT_RE = re.compile(br"\d+")
+    _ENCODING = "utf-8"
+
+    def __init__(self, buffer, symbols=None, header=True):
+        """All threads share symbols, new SymbolTable is used by default.
+
+        If header is False, buffer has no report and process headers and only
+        a MappedThreadSection can be parsed from it."""
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        # Path of mapped file, set by open.
+        self.path = None
+        self._buffer = buffer
+        self._section_spans = self._iter_section_spans()
+        self._frame_ids_by_name = {}
+        if not header:
+            return
+        try:
+            # Parse general report header (4 sections)
+            self.report_attributes = []
+            for _ in range(4):
+                self.report_attributes.append(split_on_colon(self._section_lines(self._next_section())))
+            # Parse process header.
+            self.process_attributes = split_on_colon(self._section_lines(self._next_section()))
+        except BaseException:
+            self.close()
+            raise
+
+    @classmethod
+    @contextlib.contextmanager
+    def open(cls, path, symbols=None):
+        """Yields parser of memory-mapped report file at path."""
+        with mapped_file(path) as buffer:
+            parser = cls(buffer, symbols)
+            parser.path = path
+            try:
+                yield parser
+            finally:
+                parser.close()
+
+    def close(self):
+        """Releases buffer, so memory map can be closed.  Remaining threads aren't parsed."""
+        self._section_spans = iter(())
+        self._buffer = b""
+
+    def _next_section(self):
+        span = next(self._section_spans, None)
+        assert span is not None, "Unexpected end of report"
+        return span
+
+    def _iter_section_spans(self):
+        buffer = self._buffer
+        start = 0
+        end = len(buffer)
+        # Empty lines before the first and after the last section.
+        while buffer[start:start + 1] in (b"\r", b"\n") and start < end:
+            start += 1
+        while buffer[end - 1:end] in (b"\r", b"\n") and end > start:
+            end -= 1
+        for separator_match in self._SECTION_SEPARATOR_RE.finditer(buffer, start, end):
+            yield start, separator_match.start()
+            start = separator_match.end()
+        if end > start:
+            yield start, end
+
+    def _section_lines(self, span):
+        start, end = span
+        text = self._buffer[start:end].decode(self._ENCODING, "replace")
+        return [line.rstrip("\r") for line in text.split("\n")]
+
+    def iter_thread_traces(self):
+        """Yields ThreadTrace for every thread section as soon as it is read."""
+        for description, start, end in self._iter_thread_spans():
+            yield self._thread_trace(description, start, end)
+
+    def iter_thread_sections(self):
+        """Yields MappedThreadSection for every thread, so threads can be parsed in other processes.
+
+        Threads parsed this way don't share symbols."""
+        assert self.path is not None, "Thread sections are available only for parsers created by open"
+        for description, start, end in self._iter_thread_spans():
+            yield MappedThreadSection(self.path, description, start, end)
+
+    def _iter_thread_spans(self):
+        buffer = self._buffer
+        while True:
+            with _instrumentation.stage("split_sections"):
+                span = next(self._section_spans, None)
+            if span is None or buffer[span[0]:span[0] + 1] != b" ":
+                # Process sections are indented, everything else isn't part of process.
+                break
+            start, end = span
+            header_end = buffer.find(b"\n", start, end)
+            if header_end < 0:
+                header_end = end
+            header = buffer[start:header_end].decode(self._ENCODING, "replace").strip()
+            if header.startswith("Thread"):
+                yield header, header_end, end
+
+    def process_trace(self):
+        return ProcessTrace.from_thread_traces(self.process_attributes, self.iter_thread_traces(), self.symbols)
+
+    def _thread_trace(self, description, start, end):
+        with _instrumentation.stage("parse_thread") as stage:
+            frame_tree = FrameTree(self.symbols)
+            frame_tree.extend_preorder(self._iter_frame_nodes(start, end))
+            stage.count("nodes", len(frame_tree))
+        return ThreadTrace.from_frame_tree(description, frame_tree)
+
+    def _iter_frame_nodes(self, start, end):
+        buffer = self._buffer
+        frame_ids_by_name = self._frame_ids_by_name
+        frame_line_match = self._FRAME_LINE_RE.match
+        line_start = start
+        while line_start < end:
+            line_end = buffer.find(b"\n", line_start, end)
+            if line_end < 0:
+                line_end = end
+            line_match = frame_line_match(buffer, line_start, line_end)
+            if line_match is not None:
+                indentation = line_match.end(1) - line_start
+                sample_count = line_match.group(2)
+                name = line_match.group(3)
+            else:
+                # Indentation is anything before sample count, like in ThreadTrace, e.g. "   *3 ...".
+                name_end = line_end
+                if buffer[name_end - 1:name_end] == b"\r":
+                    name_end -= 1
+                if name_end <= line_start:
+                    line_start = line_end + 1
+                    continue
+                digit_match = self._DIGIT_RE.search(buffer, line_start, name_end)
+                assert digit_match is not None, "No sample count in line %r" % buffer[line_start:name_end]
+                indentation = digit_match.start() - line_start
+                sample_count = digit_match.group()
+                name = buffer[digit_match.end() + 1:name_end]
+            depth, remainder = divmod(indentation, ThreadTrace._INDENTATION)
+            assert remainder == 0 and depth > 0, "Unexpected indentation in line %r" % name
+            frame_id = frame_ids_by_name.get(name)
+            if frame_id is None:
+                frame_id = frame_ids_by_name[name] = self.symbols.intern(name.decode(self._ENCODING, "replace"))
+            # Root frame is indented once.
+            yield depth - 1, frame_id, int(sample_count)
+            line_start = line_end + 1
+
+
+class MappedThreadSection:
+    """Location of thread section in report file, which can be parsed in another process.
+
+    Unlike ThreadTrace, it is small and cheap to send to a worker process."""
+    def __init__(self, path, description, start, end):
+        self.path = path
+        self.description = description
+        self.start = start
+        self.end = end
+
+    def thread_trace(self, symbols=None):
+        """Maps report file and parses the thread, new SymbolTable is used by default."""
+        with mapped_file(self.path) as buffer:
+            parser = MappedTraceReportParser(buffer, symbols, header=False)
+            parser.path = self.path
+            try:
+                return parser._thread_trace(self.description, self.start, self.end)
+            finally:
+                parser.close()
+
+
+@contextlib.contextmanager
+def mapped_file(path):
+    """Yields read-only memory map of file at path, empty bytes for empty file."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
+
+_DECOMPRESSORS = {".gz": gzip.GzipFile, ".bz2": bz2.BZ2File, ".xz": lzma.LZMAFile}
+# Raised for files which aren't reports, e.g. by parser assertions, decoding or
+# decompressing a truncated or corrupt .gz, .bz2 or .xz file.
+_REPORT_ERRORS = (AssertionError, ValueError, OSError, EOFError, lzma.LZMAError)
+
+
+def is_compressed(path):
+    """Returns True if file at path is decompressed when read, judging by its extension."""
+    return os.path.splitext(path)[1].lower() in _DECOMPRESSORS
+
+
+def open_text_file(path):
+    """Opens text file for reading, .gz, .bz2 and .xz files are decompressed as they are read."""
+    decompressor = _DECOMPRESSORS.get(os.path.splitext(path)[1].lower())
+    if decompressor is None:
+        return io.open(path, "rt", encoding="utf-8", errors="replace")
+    return io.TextIOWrapper(decompressor(path, "rb"), encoding="utf-8", errors="replace")
+
+
+@contextlib.contextmanager
+def open_report_parser(path, symbols=None):
+    """Yields parser of report file at path.
+
+    Plain files are memory-mapped and parsed with MappedTraceReportParser.
+    Compressed files can't be mapped, they are decompressed while they are
+    parsed with TraceReportParser, no uncompressed copy is made."""
+    if is_compressed(path):
+        with open_text_file(path) as report_file:
+            yield TraceReportParser(report_file, symbols)
+    else:
+        with MappedTraceReportParser.open(path, symbols) as parser:
+            yield parser
+
+
+class TraceReport:
+    def __init__(self, lines):
+        """Lines can be a list or any other iterable of lines, e.g. a file object."""
+        parser = TraceReportParser(lines)
+        self.report_attributes = parser.report_attributes
+        self.process_trace = parser.process_trace()
+
+    @classmethod
+    def from_process_trace(cls, report_attributes, process_trace):
+        report = cls.__new__(cls)
+        report.report_attributes = report_attributes
+        report.process_trace = process_trace
+        return report
+
+    @classmethod
+    def from_file(cls, path):
+        """Parses report file at path, which can be compressed, see open_report_parser."""
+        with open_report_parser(path) as parser:
+            return cls.from_process_trace(parser.report_attributes, parser.process_trace())
 
 
 # Parsing traces.
+def iter_sections(lines):
+    """Yields groups of consecutive non-empty lines.  Empty lines are skipped.
+
+    Trailing newline characters are removed, so file objects can be used as lines."""
+    section = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if len(line) > 0:
+            section.append(line)
+        elif len(section) > 0:
+            yield section
+            section = []
+    if len(section) > 0:
+        yield section
+
+
+def is_thread_section(section):
+    return section[0].lstrip().startswith("Thread")
+
+
 def take_until_empty_line(lines):
     """Returns first_lines and rest_lines."""
     assert len(lines) > 0
@@ -136,51 +1335,174 @@ def split_on_colon(lines):
     return result
 
 
+class TextFitter:
+    """Truncates text with ellipsis so it fits given width in Helvetica.
+
+    Cumulative glyph widths of every text are computed once and truncation
+    point is found by binary search.  Results are memoized per (text id,
+    width bucket), text itself is used as id by default."""
+    # Helvetica glyph widths for characters from " " to "~" in 1/1000 of font size.
+    _GLYPH_WIDTHS = (
+        278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+        556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+        1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+        667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+        333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+        556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584)
+    _FIRST_GLYPH = 32
+    _DEFAULT_GLYPH_WIDTH = 556
+    _ELLIPSIS = '\u2026'
+    _ELLIPSIS_GLYPH_WIDTH = 1000
+
+    def __init__(self, font_size=12, bucket_width=1., max_memoized_texts=100000):
+        self.font_size = font_size
+        self.bucket_width = bucket_width
+        self.max_memoized_texts = max_memoized_texts
+        self.ellipsis_width = self._ELLIPSIS_GLYPH_WIDTH * font_size / 1000.
+        self._glyph_widths = [glyph_width * font_size / 1000. for glyph_width in self._GLYPH_WIDTHS]
+        self._default_glyph_width = self._DEFAULT_GLYPH_WIDTH * font_size / 1000.
+        self._prefix_widths = {}
+        self._fitted_texts = {}
+
+    def glyph_width(self, character):
+        glyph_index = ord(character) - self._FIRST_GLYPH
+        if 0 <= glyph_index < len(self._glyph_widths):
+            return self._glyph_widths[glyph_index]
+        return self._default_glyph_width
+
+    def prefix_widths(self, text, text_id=None):
+        """Returns widths of all text prefixes, from empty one to the whole text."""
+        if text_id is None:
+            text_id = text
+        prefix_widths = self._prefix_widths.get(text_id)
+        if prefix_widths is None:
+            if len(self._prefix_widths) >= self.max_memoized_texts:
+                self._prefix_widths.clear()
+            prefix_widths = [0.]
+            text_width = 0.
+            for character in text:
+                text_width += self.glyph_width(character)
+                prefix_widths.append(text_width)
+            self._prefix_widths[text_id] = prefix_widths
+        return prefix_widths
+
+    def text_width(self, text):
+        return self.prefix_widths(text)[-1]
+
+    def fit(self, text, width, text_id=None):
+        """Returns text truncated to fit width, None if not even a single character fits.
+
+        width is rounded down to a multiple of bucket_width."""
+        if text_id is None:
+            text_id = text
+        bucket = int(width // self.bucket_width)
+        key = (text_id, bucket)
+        try:
+            return self._fitted_texts[key]
+        except KeyError:
+            pass
+        if len(self._fitted_texts) >= self.max_memoized_texts:
+            self._fitted_texts.clear()
+        width = bucket * self.bucket_width
+        prefix_widths = self.prefix_widths(text, text_id)
+        if prefix_widths[-1] <= width:
+            fitted_text = text
+        else:
+            # prefix_widths[i] is width of text[:i].
+            bounded_text_length = bisect.bisect_right(prefix_widths, width - self.ellipsis_width) - 1
+            if bounded_text_length < 1:
+                # width is too small to display at least 1 symbol with ellipsis.
+                fitted_text = None
+            else:
+                fitted_text = text[:bounded_text_length] + self._ELLIPSIS
+        self._fitted_texts[key] = fitted_text
+        return fitted_text
+
+
 class SVG:
     _HEADER = """<svg width="{width}" height="{height}" viewBox="0 0 {width} {height}"
 version="1.1" xmlns="http://www.w3.org/2000/svg">"""
     _FOOTER = """</svg>"""
-    _SYMBOL_WIDTH = 5.7
-    _ELLIPSIS_WIDTH = 12.0
+    _TEXT_FITTER = TextFitter()
 
     def __init__(self, width, height):
         self.width = width
         self.height = height
         self.content_lines = []
 
-    def add_rect(self, x, y, width, height, color):
-        self.content_lines.append(
+    def _add_line(self, line):
+        self.content_lines.append(line)
+
+    def add_rect(self, x, y, width, height, color, css_class=None):
+        """Rect is filled with color, or with a CSS class when css_class is provided."""
+        if css_class is None:
+            fill = 'fill="{color}"'.format(color=color)
+        else:
+            fill = 'class="{css_class}"'.format(css_class=css_class)
+        self._add_line(
             '<rect x="{x:.1f}" y="{y:.1f}" width="{width:.1f}" '
-            'height="{height:.1f}" fill="{color}" rx="2" ry="2" />'.format(
-                x=x, y=y, width=width, height=height, color=color))
+            'height="{height:.1f}" {fill} rx="2" ry="2" />'.format(
+                x=x, y=y, width=width, height=height, fill=fill))
+
+    def add_style(self, css):
+        self._add_line('<style type="text/css">{css}</style>'.format(css=css))
 
     def add_text(self, text, x, y):
         text = saxutils.escape(text)
-        self.content_lines.append(
+        self._add_line(
             '<text x="{x:.1f}" y="{y:.1f}" font-size="12" '
             'font-family="Helvetica">{text}</text>'.format(
                 x=x, y=y, text=text))
 
-    def add_bounded_text(self, text, x, y, width):
-        text_width = len(text) * SVG._SYMBOL_WIDTH
-        if text_width > width:
-            bounded_text_length = int((width - SVG._ELLIPSIS_WIDTH) / SVG._SYMBOL_WIDTH)
-            if bounded_text_length < 1:
-                # width is too small to display at least 1 symbol with ellipsis.
-                # Don't add any text.
-                return
-            else:
-                text = text[:bounded_text_length]
-                text += '\u2026'  # Add ellipsis
-        self.add_text(text, x, y)
+    def add_bounded_text(self, text, x, y, width, text_fitter=None, text_id=None):
+        """Adds text truncated to width, adds nothing if width is too small.
+
+        text_id identifies text for memoization in text_fitter, e.g. frame id."""
+        if text_fitter is None:
+            text_fitter = SVG._TEXT_FITTER
+        text = text_fitter.fit(text, width, text_id)
+        if text is not None:
+            self.add_text(text, x, y)
+
+    def add_group(self, svg, y):
+        """Adds content of another SVG shifted down by y."""
+        self._add_line('<g transform="translate(0,{y:.1f})">'.format(y=y))
+        for line in svg.content_lines:
+            self._add_line(line)
+        self._add_line('</g>')
 
     def dump(self, stream):
         """stream should support writing unicode strings."""
-        stream.write(self._HEADER.format(width=self.width, height=self.height))
-        stream.write("\n")
-        stream.write("\n".join(self.content_lines))
+        with _instrumentation.stage("svg_dump") as stage:
+            stream.write(self._HEADER.format(width=self.width, height=self.height))
+            stream.write("\n")
+            for line_index, line in enumerate(self.content_lines):
+                if line_index > 0:
+                    stream.write("\n")
+                stream.write(line)
+            stream.write("\n")
+            stream.write(self._FOOTER)
+            stage.count("elements", len(self.content_lines))
+
+
+class StreamingSVG(SVG):
+    """SVG which writes elements to stream as soon as they are added.
+
+    Header is written on creation, so dimensions should be known in advance.
+    Call close() to write the footer.  Elements aren't kept in memory."""
+    def __init__(self, stream, width, height):
+        """stream should support writing unicode strings."""
+        SVG.__init__(self, width, height)
+        self.stream = stream
+        stream.write(self._HEADER.format(width=width, height=height))
         stream.write("\n")
-        stream.write(self._FOOTER)
+
+    def _add_line(self, line):
+        self.stream.write(line)
+        self.stream.write("\n")
+
+    def close(self):
+        self.stream.write(self._FOOTER)
 
 
 class Color:
@@ -249,6 +1571,14 @@ class RGBColor(Color):
         return Color.xyz(*xyz_components)
 
 
+def _lab_f_inverse(t):
+    """Inverse of the L*a*b* nonlinearity, shared by LabColor and batch color conversion."""
+    if t > (6.0 / 29.0):
+        return t ** 3
+    else:
+        return 3 * ((6.0 / 29.0) ** 2) * (t - (4.0 / 29.0))
+
+
 class LabColor(Color):
     def __init__(self, l, a, b):
         self.l = l
@@ -270,17 +1600,15 @@ class LabColor(Color):
         y = (l + 16.0) / 116.0
         x = y + a / 500.0
         z = y - b / 200.0
-        def f_inverse(t):
-            if t > (6.0 / 29.0):
-                return t ** 3
-            else:
-                return 3 * ((6.0 / 29.0) ** 2) * (t - (4.0 / 29.0))
-        xyz_components = map(lambda c, ref_c: ref_c * f_inverse(c), (x, y, z), XYZColor._WHITE_POINT_REF)
+        xyz_components = map(lambda c, ref_c: ref_c * _lab_f_inverse(c), (x, y, z), XYZColor._WHITE_POINT_REF)
         return Color.xyz(*xyz_components)
 
 
 class XYZColor(Color):
     _WHITE_POINT_REF = (0.95043, 1.00000, 1.08890)
+    _TO_RGB_COEFFICIENTS = ((3.2406, -1.5372, -0.4986),
+                            (-0.9689, 1.8758, 0.0415),
+                            (0.0557, -0.2040, 1.0570))
 
     def __init__(self, x, y, z):
         self.x = x
@@ -293,10 +1621,7 @@ class XYZColor(Color):
     def as_rgb(self):
         # See http://en.wikipedia.org/wiki/SRGB
         components = self._native_components()
-        xyz_to_rgb_coefficients = ((3.2406, -1.5372, -0.4986),
-                                   (-0.9689, 1.8758, 0.0415),
-                                   (0.0557, -0.2040, 1.0570))
-        rgb_components = self._multiply_matrix_vector(xyz_to_rgb_coefficients, components)
+        rgb_components = self._multiply_matrix_vector(XYZColor._TO_RGB_COEFFICIENTS, components)
         # WARNING: again, no gamma correction
         rgb_components = [int(c * 255) for c in rgb_components]
         return Color.rgb(*rgb_components)
@@ -325,8 +1650,8 @@ def linear_interpolation(from_list, to_list, t):
     assert 0.0 <= t <= 1.0
     assert len(from_list) == len(to_list)
     t = float(t)
-    result = map(lambda from_el, to_el: (from_el + t * (to_el - from_el)),
-                 from_list, to_list)
+    result = [from_el + t * (to_el - from_el)
+              for from_el, to_el in zip(from_list, to_list)]
     return result
 
 
@@ -341,6 +1666,24 @@ class ColorInterpolator:
         result_components = linear_interpolation(from_components, to_components, position)
         return Color.lab(*result_components)
 
+    def rgb_strings_at_positions(self, positions):
+        """Returns list of RGB strings for an iterable of positions."""
+        from_l, from_a, from_b = self.from_color.lab_components()
+        to_l, to_a, to_b = self.to_color.lab_components()
+        return [_lab_to_rgb_string(from_l + position * (to_l - from_l),
+                                   from_a + position * (to_a - from_a),
+                                   from_b + position * (to_b - from_b))
+                for position in map(float, positions)]
+
+    def cache_key(self):
+        """Returns hashable key which is equal for interpolators with equal colors."""
+        return ("ColorInterpolator", tuple(self.from_color.lab_components()), tuple(self.to_color.lab_components()))
+
+    def lookup_table(self, steps=256):
+        """Returns ColorLookupTable with colors precomputed for steps positions."""
+        positions = ColorLookupTable.grid_positions(steps)
+        return ColorLookupTable(self.rgb_strings_at_positions(positions), steps, 1)
+
 
 class ColorRectInterpolator:
     def __init__(self, left_bottom_color, left_top_color, right_bottom_color, right_top_color):
@@ -348,18 +1691,142 @@ class ColorRectInterpolator:
         self.left_top_color = left_top_color
         self.right_bottom_color = right_bottom_color
         self.right_top_color = right_top_color
+        # Corner colors don't change, convert them to Lab only once.
+        self._left_bottom_components = tuple(left_bottom_color.lab_components())
+        self._left_top_components = tuple(left_top_color.lab_components())
+        self._right_bottom_components = tuple(right_bottom_color.lab_components())
+        self._right_top_components = tuple(right_top_color.lab_components())
 
     def color_at_pos(self, x_pos, y_pos):
         left_components = linear_interpolation(
-            self.left_bottom_color.lab_components(),
-            self.left_top_color.lab_components(), y_pos)
+            self._left_bottom_components, self._left_top_components, y_pos)
         right_components = linear_interpolation(
-            self.right_bottom_color.lab_components(),
-            self.right_top_color.lab_components(), y_pos)
+            self._right_bottom_components, self._right_top_components, y_pos)
         result_components = linear_interpolation(
             left_components, right_components, x_pos)
         return Color.lab(*result_components)
 
+    def rgb_strings_at_positions(self, positions):
+        """Returns list of RGB strings for an iterable of (x_pos, y_pos) pairs.
+
+        Result is the same as color_at_pos(x_pos, y_pos).rgb_string() for every
+        pair, but no intermediate Color objects are created."""
+        lb_l, lb_a, lb_b = self._left_bottom_components
+        lt_l, lt_a, lt_b = self._left_top_components
+        rb_l, rb_a, rb_b = self._right_bottom_components
+        rt_l, rt_a, rt_b = self._right_top_components
+        result = []
+        append = result.append
+        for x_pos, y_pos in positions:
+            x_pos = float(x_pos)
+            y_pos = float(y_pos)
+            left_l = lb_l + y_pos * (lt_l - lb_l)
+            left_a = lb_a + y_pos * (lt_a - lb_a)
+            left_b = lb_b + y_pos * (lt_b - lb_b)
+            right_l = rb_l + y_pos * (rt_l - rb_l)
+            right_a = rb_a + y_pos * (rt_a - rb_a)
+            right_b = rb_b + y_pos * (rt_b - rb_b)
+            append(_lab_to_rgb_string(left_l + x_pos * (right_l - left_l),
+                                      left_a + x_pos * (right_a - left_a),
+                                      left_b + x_pos * (right_b - left_b)))
+        return result
+
+    def cache_key(self):
+        """Returns hashable key which is equal for interpolators with equal colors."""
+        return ("ColorRectInterpolator", self._left_bottom_components, self._left_top_components,
+                self._right_bottom_components, self._right_top_components)
+
+    def lookup_table(self, x_steps=256, y_steps=256):
+        """Returns ColorLookupTable with colors precomputed for x_steps * y_steps positions."""
+        x_positions = ColorLookupTable.grid_positions(x_steps)
+        positions = [(x_pos, y_pos)
+                     for y_pos in ColorLookupTable.grid_positions(y_steps)
+                     for x_pos in x_positions]
+        return ColorLookupTable(self.rgb_strings_at_positions(positions), x_steps, y_steps)
+
+
+_LOOKUP_TABLE_CACHE_SIZE = 32
+_lookup_tables = collections.OrderedDict()
+_lookup_tables_lock = threading.Lock()
+
+
+def cached_lookup_table(interpolator, *steps):
+    """Returns interpolator.lookup_table(*steps), the most recently used tables are reused.
+
+    Tables are keyed by interpolator colors rather than by interpolator, so
+    they are reused by copies of settings too, e.g. in worker processes."""
+    key = (interpolator.cache_key(),) + steps
+    with _lookup_tables_lock:
+        lookup_table = _lookup_tables.pop(key, None)
+        if lookup_table is not None:
+            _lookup_tables[key] = lookup_table
+            return lookup_table
+    lookup_table = interpolator.lookup_table(*steps)
+    with _lookup_tables_lock:
+        _lookup_tables[key] = lookup_table
+        while len(_lookup_tables) > _LOOKUP_TABLE_CACHE_SIZE:
+            _lookup_tables.popitem(last=False)
+    return lookup_table
+
+
+class ColorLookupTable:
+    """Colors precomputed for a grid of positions, lookup is O(1).
+
+    Positions are rounded to the closest grid point.  Every distinct color has
+    a CSS class, so SVG can reference the class instead of repeating the color."""
+    def __init__(self, fills, x_steps, y_steps):
+        """fills are RGB strings for grid points, row by row (x changes first)."""
+        assert len(fills) == x_steps * y_steps
+        self.x_steps = x_steps
+        self.y_steps = y_steps
+        self.fills = fills
+        css_classes_by_fill = dict((fill, self.css_class_for_fill(fill)) for fill in set(fills))
+        self.css_classes = [css_classes_by_fill[fill] for fill in fills]
+        self._fills_by_css_class = dict((css_class, fill) for fill, css_class in css_classes_by_fill.items())
+
+    @staticmethod
+    def grid_positions(steps):
+        if steps == 1:
+            return [0.]
+        return [float(i) / (steps - 1) for i in range(steps)]
+
+    @staticmethod
+    def css_class_for_fill(fill):
+        """Class name depends only on fill, so tables for different threads are consistent."""
+        return "c" + "_".join(re.findall(r"-?\d+", fill))
+
+    def _grid_index(self, x_pos, y_pos):
+        x_index = int(x_pos * (self.x_steps - 1) + 0.5)
+        y_index = int(y_pos * (self.y_steps - 1) + 0.5)
+        return y_index * self.x_steps + x_index
+
+    def fill_at_pos(self, x_pos, y_pos=0.):
+        return self.fills[self._grid_index(x_pos, y_pos)]
+
+    def css_class_at_pos(self, x_pos, y_pos=0.):
+        return self.css_classes[self._grid_index(x_pos, y_pos)]
+
+    def stylesheet(self, css_classes=None):
+        """Returns CSS rules for css_classes, by default for all classes of the table."""
+        if css_classes is None:
+            css_classes = self._fills_by_css_class.keys()
+        return "".join(".{0}{{fill:{1}}}".format(css_class, self._fills_by_css_class[css_class])
+                       for css_class in sorted(css_classes))
+
+
+def _lab_to_rgb_string(l, a, b):
+    """Same as Color.lab(l, a, b).rgb_string(), but without intermediate objects."""
+    ref_x, ref_y, ref_z = XYZColor._WHITE_POINT_REF
+    y = (l + 16.0) / 116.0
+    x = ref_x * _lab_f_inverse(y + a / 500.0)
+    z = ref_z * _lab_f_inverse(y - b / 200.0)
+    y = ref_y * _lab_f_inverse(y)
+    (r_x, r_y, r_z), (g_x, g_y, g_z), (b_x, b_y, b_z) = XYZColor._TO_RGB_COEFFICIENTS
+    # WARNING: no gamma correction, see XYZColor.as_rgb
+    return "rgb({0}, {1}, {2})".format(int((r_x * x + r_y * y + r_z * z) * 255),
+                                       int((g_x * x + g_y * y + g_z * z) * 255),
+                                       int((b_x * x + b_y * y + b_z * z) * 255))
+
 
 class ColorGenerator:
     def __init__(self, base_color_triplet, max_deviation_triplet):
@@ -385,39 +1852,882 @@ class UnicodeToBinaryStreamWrapper:
     def write(self, unicode_str):
         self.stream.write(unicode_str.encode('utf-8'))
 
-def main():
-    # Read and parse spindump.
-    filename = sys.argv[1]
-    #filename = "test_data/Xcode_2013-08-30-203227_Volodymyrs-Mac-mini.hang"
-    lines = []
-    with open(filename, "rt") as f:
-        lines = f.read().splitlines()
-    report = TraceReport(lines)
-    # Build SVG file.
-    thread_trace = report.process_trace.threads[0]
-    sample_height = 16.
-    total_width = 1200
+
+@contextlib.contextmanager
+def gzip_stream(binary_stream):
+    """Yields binary stream which compresses written data into binary_stream with gzip.
+
+    Data is compressed incrementally as it is written.  binary_stream isn't closed."""
+    gzip_file = gzip.GzipFile(filename="", mode="wb", fileobj=binary_stream)
+    # SVG is written in small pieces, compressing each of them separately is slow.
+    buffered_file = io.BufferedWriter(gzip_file, 64 * 1024)
+    try:
+        yield buffered_file
+    finally:
+        # Closes gzip_file too, which writes gzip trailer.
+        buffered_file.close()
+
+
+@contextlib.contextmanager
+def open_output_stream(path=None, compress=False):
+    """Yields text stream writing to file at path, stdout by default.
+
+    Output is compressed with gzip if compress is set or path ends with .svgz."""
+    if path is None:
+        binary_stream = getattr(sys.stdout, "buffer", sys.stdout)
+    else:
+        binary_stream = io.open(path, "wb")
+        compress = compress or path.lower().endswith(".svgz")
+    try:
+        if compress:
+            with gzip_stream(binary_stream) as compressed_stream:
+                yield UnicodeToBinaryStreamWrapper(compressed_stream)
+        else:
+            yield UnicodeToBinaryStreamWrapper(binary_stream)
+    finally:
+        if path is None:
+            binary_stream.flush()
+        else:
+            binary_stream.close()
+
+# Rendering.
+class FlameGraphSettings:
+    """Parameters of rendered flame graphs, the same for all threads."""
+    def __init__(self, total_width=1200, sample_height=16.):
+        self.total_width = total_width
+        self.sample_height = sample_height
+        # When set, colors are quantized to color_lookup_steps horizontal
+        # positions and referenced through CSS classes.
+        self.color_lookup_steps = None
+        # Frames narrower than min_frame_width pixels are skipped together with
+        # their children.  Adjacent skipped frames can be merged into one.
+        self.min_frame_width = 0.1
+        self.merge_narrow_frames = False
+        # Frames matching highlight regular expression are filled with highlight_color.
+        self.highlight = None
+        self.highlight_color = "rgb(230, 0, 230)"
+        #color_generator = ColorGenerator((180, 115, 28), (25, 115, 28))
+        # color_interpolator = ColorInterpolator(Color.rgb(0xff, 0xed, 0xa0),
+        #                                        Color.rgb(0xf0, 0x3b, 0x20))
+        self.color_interpolator = ColorRectInterpolator(
+            Color.rgb(0xff, 0xed, 0xa0), Color.rgb(0xf0, 0x3b, 0x20),
+            Color.rgb(0xf7, 0xfc, 0xb9), Color.rgb(0x31, 0xa3, 0x54))
+        # Differential graphs go from unchanged color to these colors
+        # as the sample count delta grows.
+        self.diff_increase_interpolator = ColorInterpolator(Color.rgb(0xf0, 0xf0, 0xf0), Color.rgb(0xd7, 0x30, 0x27))
+        self.diff_decrease_interpolator = ColorInterpolator(Color.rgb(0xf0, 0xf0, 0xf0), Color.rgb(0x45, 0x75, 0xb4))
+
+
+def iter_visible_frames(frame_tree, min_sample_count, merge_narrow_frames=False):
+    """Yields (index, start, depth, sample_count) for frames at least min_sample_count wide.
+
+    Narrower frames are pruned together with their subtrees, children of pruned
+    frames aren't visited at all.  If merge_narrow_frames is set, consecutive
+    pruned siblings are merged into a single frame with index -1 when they are
+    wide enough together."""
+    if frame_tree.sample_counts[0] < min_sample_count:
+        return
+    starts = frame_tree.starts
+    sample_counts = frame_tree.sample_counts
+    stack = [(0, starts[0], frame_tree.depths[0], sample_counts[0])]
+    while len(stack) > 0:
+        frame = stack.pop()
+        yield frame
+        index, _, depth, _ = frame
+        if index < 0:
+            continue
+        visible_children = []
+        merged_start = None
+        merged_sample_count = 0
+        for child in frame_tree.children(index):
+            sample_count = sample_counts[child]
+            if sample_count >= min_sample_count:
+                if merged_sample_count >= min_sample_count and merge_narrow_frames:
+                    visible_children.append((-1, merged_start, depth + 1, merged_sample_count))
+                merged_sample_count = 0
+                visible_children.append((child, starts[child], depth + 1, sample_count))
+            else:
+                if merged_sample_count == 0:
+                    merged_start = starts[child]
+                merged_sample_count += sample_count
+        if merged_sample_count >= min_sample_count and merge_narrow_frames:
+            visible_children.append((-1, merged_start, depth + 1, merged_sample_count))
+        visible_children.reverse()
+        stack.extend(visible_children)
+
+
+def draw_thread_trace(svg, thread_trace, settings):
+    """Draws frames of thread_trace, the root frame is at the bottom of svg.
+
+    Frames narrower than settings.min_frame_width aren't drawn, nothing is
+    drawn for a trace without samples."""
+    frame_tree = thread_trace.frame_tree
+    if frame_tree.sample_counts[0] == 0:
+        return
+    sample_height = settings.sample_height
+    total_width = settings.total_width
     max_stack_depth = thread_trace.max_stack_depth()
     height = sample_height * max_stack_depth
-    svg = SVG(total_width, height)
-    #color_generator = ColorGenerator((180, 115, 28), (25, 115, 28))
-    # color_interpolator = ColorInterpolator(Color.rgb(0xff, 0xed, 0xa0),
-    #                                        Color.rgb(0xf0, 0x3b, 0x20))
-    color_interpolator = ColorRectInterpolator(
-        Color.rgb(0xff, 0xed, 0xa0), Color.rgb(0xf0, 0x3b, 0x20),
-        Color.rgb(0xf7, 0xfc, 0xb9), Color.rgb(0x31, 0xa3, 0x54))
-    width_per_sample = total_width / thread_trace.root_frame.sample_count
+    width_per_sample = float(total_width) / frame_tree.sample_counts[0]
+    with _instrumentation.stage("layout") as stage:
+        visible_frames = list(iter_visible_frames(
+            frame_tree, settings.min_frame_width / width_per_sample, settings.merge_narrow_frames))
+        stage.count("nodes", len(frame_tree))
+        stage.count("visible_frames", len(visible_frames))
+    relative_positions = ((float(start * width_per_sample) / total_width, float(depth) / max_stack_depth)
+                          for _, start, depth, _ in visible_frames)
+    with _instrumentation.stage("color") as stage:
+        stage.count("frames", len(visible_frames))
+        if thread_trace.sample_deltas is not None:
+            colors, css_classes = _diff_colors(svg, thread_trace.sample_deltas, visible_frames, settings)
+        elif settings.color_lookup_steps is None:
+            colors = settings.color_interpolator.rgb_strings_at_positions(relative_positions)
+            css_classes = None
+        else:
+            # Depths map exactly to rows of the table.
+            lookup_table = cached_lookup_table(settings.color_interpolator,
+                                               settings.color_lookup_steps, max_stack_depth + 1)
+            colors = None
+            css_classes = [lookup_table.css_class_at_pos(x_pos, y_pos) for x_pos, y_pos in relative_positions]
+            svg.add_style(lookup_table.stylesheet(set(css_classes)))
+        if settings.highlight is not None:
+            _highlight(svg, thread_trace, visible_frames, settings, colors, css_classes)
+    # Frame ids are unique only within symbol table, so memoize per thread.
+    text_fitter = TextFitter()
     # Draw samples' rectangles.
-    for frame, start, depth in thread_trace.root_frame.iteritems():
-        x = start * width_per_sample
-        y = height - depth * sample_height
-        width = frame.sample_count * width_per_sample
-        x_relative = float(x) / total_width
-        y_relative = float(depth) / max_stack_depth
-        color = color_interpolator.color_at_pos(x_relative, y_relative).rgb_string()
-        svg.add_rect(x, y - sample_height, width, sample_height - 1., color)
-        svg.add_bounded_text(frame.frame, x + 2., y - 4., width - 2.)
-    svg.dump(UnicodeToBinaryStreamWrapper(sys.stdout))
+    with _instrumentation.stage("svg") as stage:
+        for frame_number, (index, start, depth, sample_count) in enumerate(visible_frames):
+            x = start * width_per_sample
+            y = height - depth * sample_height
+            width = sample_count * width_per_sample
+            if css_classes is None:
+                svg.add_rect(x, y - sample_height, width, sample_height - 1., colors[frame_number])
+            else:
+                svg.add_rect(x, y - sample_height, width, sample_height - 1., None, css_classes[frame_number])
+            if index >= 0:
+                svg.add_bounded_text(frame_tree.frame(index), x + 2., y - 4., width - 2.,
+                                     text_fitter, frame_tree.frame_ids[index])
+            else:
+                svg.add_bounded_text("[narrow frames]", x + 2., y - 4., width - 2.)
+        stage.count("rects", len(visible_frames))
+
+
+def _highlight(svg, thread_trace, visible_frames, settings, colors, css_classes):
+    """Replaces colors or CSS classes of frames matching settings.highlight."""
+    highlighted_ids = thread_trace.frame_index().search(settings.highlight)
+    frame_ids = thread_trace.frame_tree.frame_ids
+    highlighted_frame_numbers = [frame_number for frame_number, (index, _, _, _) in enumerate(visible_frames)
+                                 if index >= 0 and frame_ids[index] in highlighted_ids]
+    if css_classes is None:
+        for frame_number in highlighted_frame_numbers:
+            colors[frame_number] = settings.highlight_color
+        return
+    css_class = ColorLookupTable.css_class_for_fill(settings.highlight_color)
+    for frame_number in highlighted_frame_numbers:
+        css_classes[frame_number] = css_class
+    svg.add_style(".{0}{{fill:{1}}}".format(css_class, settings.highlight_color))
+
+
+def write_hot_frames(stream, frame_index, count):
+    """Writes tables of count frames with the most self and inclusive samples."""
+    for title, inclusive in (("Self samples", False), ("Inclusive samples", True)):
+        stream.write("%s:\n" % title)
+        for frame, sample_count in frame_index.top(count, inclusive):
+            stream.write("%10d  %s\n" % (sample_count, frame))
+        stream.write("\n")
+
+
+def _diff_colors(svg, sample_deltas, visible_frames, settings):
+    """Returns (colors, css_classes) of visible_frames by their sample count delta.
+
+    Deltas are relative to the largest visible one, merged narrow frames
+    are drawn as unchanged."""
+    deltas = [sample_deltas[index] if index >= 0 else 0 for index, _, _, _ in visible_frames]
+    max_delta = float(max([abs(delta) for delta in deltas] + [1]))
+    interpolators = (settings.diff_decrease_interpolator, settings.diff_increase_interpolator)
+    if settings.color_lookup_steps is None:
+        colors = [None] * len(deltas)
+        for increase, interpolator in enumerate(interpolators):
+            frame_numbers = [frame_number for frame_number, delta in enumerate(deltas) if (delta > 0) == increase]
+            frame_colors = interpolator.rgb_strings_at_positions(
+                abs(deltas[frame_number]) / max_delta for frame_number in frame_numbers)
+            for frame_number, color in zip(frame_numbers, frame_colors):
+                colors[frame_number] = color
+        return colors, None
+    lookup_tables = [cached_lookup_table(interpolator, settings.color_lookup_steps) for interpolator in interpolators]
+    css_classes = [lookup_tables[delta > 0].css_class_at_pos(abs(delta) / max_delta) for delta in deltas]
+    # Both tables start with the unchanged color, its class must be defined once.
+    decrease_classes = set(css_class for css_class, delta in zip(css_classes, deltas) if delta <= 0)
+    increase_classes = set(css_classes) - decrease_classes
+    svg.add_style(lookup_tables[0].stylesheet(decrease_classes) + lookup_tables[1].stylesheet(increase_classes))
+    return None, css_classes
+
+
+def thread_trace_height(thread_trace, settings):
+    return settings.sample_height * thread_trace.max_stack_depth()
+
+
+def render_thread_trace(thread_trace, settings):
+    svg = SVG(settings.total_width, thread_trace_height(thread_trace, settings))
+    draw_thread_trace(svg, thread_trace, settings)
+    return svg
+
+
+def write_thread_trace(stream, thread_trace, settings):
+    """Renders thread_trace directly to stream without keeping SVG elements in memory."""
+    svg = StreamingSVG(stream, settings.total_width, thread_trace_height(thread_trace, settings))
+    draw_thread_trace(svg, thread_trace, settings)
+    svg.close()
+
+
+def as_thread_trace(thread):
+    """Returns thread as is if it's ThreadTrace already, otherwise parses it as a thread section."""
+    if isinstance(thread, ThreadTrace):
+        return thread
+    if isinstance(thread, MappedThreadSection):
+        return thread.thread_trace()
+    return ThreadTrace(thread)
+
+
+def _portable_threads(threads, jobs):
+    """Yields threads in form which is cheap to send to worker processes.
+
+    Parsed threads share symbol table of the whole report, they get their own instead."""
+    for thread in threads:
+        if jobs != 1 and isinstance(thread, ThreadTrace):
+            thread = thread.with_own_symbols()
+        yield thread
+
+
+def _render_thread_section(thread_section, settings):
+    """Parses and renders a single thread, runs in worker processes."""
+    thread_trace = as_thread_trace(thread_section)
+    return thread_trace.description, render_thread_trace(thread_trace, settings)
+
+
+def _write_thread_section(numbered_thread_section, settings, output_dir, compress):
+    """Parses a single thread and writes its SVG file, runs in worker processes."""
+    thread_number, thread_section = numbered_thread_section
+    path = os.path.join(output_dir, "thread-%03d.%s" % (thread_number, "svgz" if compress else "svg"))
+    with open_output_stream(path) as stream:
+        write_thread_trace(stream, as_thread_trace(thread_section), settings)
+    return path
+
+
+def _map_in_pool(function, items, jobs, *args):
+    """Yields function(item, *args) for every item, preserving order.
+
+    Calls are spread over jobs worker processes (None means CPU count).  Items
+    are submitted lazily, so only a few of them are in flight at a time."""
+    if jobs == 1:
+        for item in items:
+            yield function(item, *args)
+        return
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        max_in_flight = 2 * (jobs or os.cpu_count() or 1)
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(function, item, *args))
+            if len(futures) >= max_in_flight:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+
+
+def render_thread_sections(thread_sections, settings, jobs=None):
+    """Yields (description, SVG) for every thread section, threads are rendered in parallel.
+
+    Already parsed ThreadTrace objects can be used instead of sections."""
+    return _map_in_pool(_render_thread_section, _portable_threads(thread_sections, jobs), jobs, settings)
+
+
+def write_thread_sections(thread_sections, settings, output_dir, jobs=None, compress=False):
+    """Writes SVG file for every thread section into output_dir, yields file paths.
+
+    Threads are parsed, rendered and written in parallel.  Already parsed
+    ThreadTrace objects can be used instead of sections.  If compress is
+    set, files are gzip compressed .svgz.  output_dir is created if needed."""
+    os.makedirs(output_dir, exist_ok=True)
+    return _map_in_pool(_write_thread_section, enumerate(_portable_threads(thread_sections, jobs)), jobs,
+                        settings, output_dir, compress)
+
+
+def stack_thread_svgs(rendered_threads, settings):
+    """Combines (description, SVG) pairs into a single SVG, threads go one under another."""
+    rendered_threads = list(rendered_threads)
+    title_height = settings.sample_height * 1.5
+    height = sum(title_height + svg.height for _, svg in rendered_threads)
+    result = SVG(settings.total_width, height)
+    y = 0.
+    for description, svg in rendered_threads:
+        result.add_bounded_text(description, 2., y + title_height - 6., settings.total_width - 2.)
+        y += title_height
+        result.add_group(svg, y)
+        y += svg.height
+    return result
+
+
+def load_merged_report(path):
+    """Parses report at path, returns frame tree of all its threads merged together."""
+    with open_report_parser(path) as parser:
+        return merge_frame_trees((thread.frame_tree for thread in parser.iter_thread_traces()),
+                                 parser.symbols)
+
+
+def iter_report_paths(directory_or_pattern):
+    """Yields files in directory or files matching a glob pattern, sorted by name."""
+    if os.path.isdir(directory_or_pattern):
+        paths = (os.path.join(directory_or_pattern, name) for name in os.listdir(directory_or_pattern))
+    else:
+        paths = glob.glob(directory_or_pattern)
+    for path in sorted(paths):
+        if os.path.isfile(path):
+            yield path
+
+
+def diff_reports(before_path, after_path, strip_addresses=True, collapse_recursion=False):
+    """Returns ThreadTrace of report at after_path with sample count deltas from report at before_path.
+
+    All threads of every report are merged together and normalized first,
+    see normalize_frame_tree.  Addresses are stripped by default, because
+    they change between runs with address space layout randomization."""
+    after_tree = normalize_frame_tree(load_merged_report(after_path), strip_addresses, collapse_recursion)
+    before_tree = normalize_frame_tree(load_merged_report(before_path), strip_addresses, collapse_recursion)
+    sample_deltas = diff_frame_trees(before_tree, after_tree)
+    thread_trace = ThreadTrace.from_frame_tree("%s vs %s" % (os.path.basename(after_path),
+                                                             os.path.basename(before_path)), after_tree)
+    thread_trace.sample_deltas = sample_deltas
+    return thread_trace
+
+
+def _try_load_merged_report(path):
+    """Returns (frame tree, None) for report at path or (None, error message) if it can't be parsed."""
+    try:
+        return load_merged_report(path), None
+    except _REPORT_ERRORS as error:
+        return None, str(error) or error.__class__.__name__
+
+
+def merge_reports(paths, jobs=None):
+    """Returns ThreadTrace with all threads of all reports merged together.
+
+    Reports are parsed in parallel, every worker merges threads of its report
+    and the results are merged into a single tree.  Files which aren't
+    reports are skipped with a warning on stderr.  Raises ValueError if there
+    is no report to merge."""
+    paths = list(paths)
+    merger = FrameTreeMerger()
+    report_count = 0
+    for path, (report_tree, error) in zip(paths, _map_in_pool(_try_load_merged_report, paths, jobs)):
+        if report_tree is None:
+            sys.stderr.write("Skipping %s: %s\n" % (path, error))
+            continue
+        with _instrumentation.stage("merge") as stage:
+            merger.add_into(report_tree, 0, merger.root)
+            stage.count("nodes", len(report_tree))
+        report_count += 1
+    if report_count == 0:
+        raise ValueError("no reports among %d files" % len(paths))
+    return ThreadTrace.from_frame_tree("%d reports" % report_count, merger.finish())
+
+
+# Caching parsed reports.
+PARSER_VERSION = 2
+
+
+class TraceCache:
+    """On-disk cache of parsed reports keyed by report content and PARSER_VERSION.
+
+    Every entry is a file with a JSON header followed by raw frame tree
+    columns, aligned to 8 bytes, so it can be loaded by copying memory or used
+    through mmap directly.  When total size of entries exceeds max_size bytes,
+    least recently used entries are removed."""
+    _MAGIC = b"FGCACHE1"
+    _ALIGNMENT = 8
+
+    def __init__(self, directory, max_size=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        # Another process may create the directory at the same time.
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_path(self, report_path):
+        content_hash = hashlib.sha1(("%d:" % PARSER_VERSION).encode("ascii"))
+        with io.open(report_path, "rb") as report_file:
+            for chunk in iter(lambda: report_file.read(1024 * 1024), b""):
+                content_hash.update(chunk)
+        return os.path.join(self.directory, content_hash.hexdigest() + ".fgcache")
+
+    def load_or_parse(self, report_path):
+        """Returns TraceReport from cache, parses the report and caches it on miss."""
+        entry_path = self.entry_path(report_path)
+        report = self.load(entry_path)
+        if report is None:
+            report = TraceReport.from_file(report_path)
+            self.store(entry_path, report)
+        return report
+
+    def load(self, entry_path):
+        """Returns cached TraceReport or None if there is no valid entry."""
+        try:
+            entry_file = io.open(entry_path, "rb")
+        except IOError:
+            return None
+        with entry_file:
+            header = self._read_header(entry_file)
+            if header is None:
+                return None
+            entry_map = mmap.mmap(entry_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                report = self._report_from_entry(header, memoryview(entry_map))
+            finally:
+                entry_map.close()
+        # Mark entry as recently used, another thread or process may have evicted it already.
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        return report
+
+    def store(self, entry_path, report):
+        process_trace = report.process_trace
+        header = {
+            "parser_version": PARSER_VERSION,
+            "byteorder": sys.byteorder,
+            "itemsizes": self._column_itemsizes(),
+            "report_attributes": report.report_attributes,
+            "process_attributes": process_trace.attributes,
+            "symbols": process_trace.symbols.names,
+            "threads": [{"description": thread.description, "node_count": len(thread.frame_tree)}
+                        for thread in process_trace.threads]}
+        header_bytes = json.dumps(header).encode("utf-8")
+        # Several threads of a server can store the same entry.
+        temporary_path = entry_path + ".%d.%d.tmp" % (os.getpid(), threading.current_thread().ident)
+        with io.open(temporary_path, "wb") as entry_file:
+            entry_file.write(self._MAGIC)
+            entry_file.write(struct.pack("<Q", len(header_bytes)))
+            entry_file.write(header_bytes)
+            self._write_padding(entry_file)
+            for thread in process_trace.threads:
+                for column_name in FrameTree.COLUMN_NAMES:
+                    getattr(thread.frame_tree, column_name).tofile(entry_file)
+                    self._write_padding(entry_file)
+        # Replaces an entry stored concurrently, on Windows too.
+        os.replace(temporary_path, entry_path)
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until total size fits max_size.
+
+        Entries removed meanwhile by another thread or process are skipped."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".fgcache"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total_size -= size
+
+    @staticmethod
+    def _column_itemsizes():
+        empty_tree = FrameTree()
+        return [getattr(empty_tree, column_name).itemsize for column_name in FrameTree.COLUMN_NAMES]
+
+    def _write_padding(self, entry_file):
+        padding = -entry_file.tell() % self._ALIGNMENT
+        entry_file.write(b"\0" * padding)
+
+    def _read_header(self, entry_file):
+        if entry_file.read(len(self._MAGIC)) != self._MAGIC:
+            return None
+        try:
+            header_length, = struct.unpack("<Q", entry_file.read(8))
+            header = json.loads(entry_file.read(header_length).decode("utf-8"))
+        except (struct.error, ValueError):
+            # Truncated or corrupted entry.
+            return None
+        if (header["parser_version"] != PARSER_VERSION or header["byteorder"] != sys.byteorder
+                or header["itemsizes"] != self._column_itemsizes()):
+            return None
+        offset = len(self._MAGIC) + 8 + header_length
+        header["columns_offset"] = offset + (-offset % self._ALIGNMENT)
+        return header
+
+    def _report_from_entry(self, header, entry_buffer):
+        """Returns TraceReport or None if entry_buffer is too short."""
+        symbols = SymbolTable()
+        for name in header["symbols"]:
+            symbols.intern(name)
+        threads = []
+        offset = header["columns_offset"]
+        for thread_header in header["threads"]:
+            frame_tree = FrameTree(symbols)
+            for column_name in FrameTree.COLUMN_NAMES:
+                column = getattr(frame_tree, column_name)
+                end = offset + thread_header["node_count"] * column.itemsize
+                if end > len(entry_buffer):
+                    # Truncated entry.
+                    return None
+                column.frombytes(entry_buffer[offset:end])
+                offset = end + (-end % self._ALIGNMENT)
+            threads.append(ThreadTrace.from_frame_tree(thread_header["description"], frame_tree))
+        process_trace = ProcessTrace([tuple(pair) for pair in header["process_attributes"]], [], symbols)
+        process_trace.threads = threads
+        report_attributes = [[tuple(pair) for pair in section] for section in header["report_attributes"]]
+        return TraceReport.from_process_trace(report_attributes, process_trace)
+
+
+# Serving rendered reports.
+class ReportCache:
+    """Keeps parsed reports in memory, least recently used ones are dropped beyond max_bytes.
+
+    Can be used from several threads.  Reports are parsed again when their
+    files change.  If trace_cache is set, it is used to parse reports."""
+    def __init__(self, max_bytes=512 * 1024 * 1024, trace_cache=None):
+        self.max_bytes = max_bytes
+        self.trace_cache = trace_cache
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Returns TraceReport of file at path."""
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        version = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                if entry[0] == version:
+                    self._entries[path] = entry
+                    return entry[1]
+                self.size -= entry[2]
+        # Parse without the lock, so cached reports are served meanwhile.
+        if self.trace_cache is not None:
+            report = self.trace_cache.load_or_parse(path)
+        else:
+            report = TraceReport.from_file(path)
+        size = report_memory_size(report)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                # Parsed concurrently by another thread.
+                self.size -= entry[2]
+            self._entries[path] = (version, report, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self._entries) > 0:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+        return report
+
+
+def report_memory_size(report):
+    """Returns approximate number of bytes used by frame trees and symbols of report."""
+    process_trace = report.process_trace
+    return (sum(sys.getsizeof(name) for name in process_trace.symbols.names) +
+            sum(thread.frame_tree.memory_size() for thread in process_trace.threads))
+
+
+def zoomed_thread_trace(thread_trace, frames):
+    """Returns ThreadTrace of subtree reached from the root through frames, None if there is no such path."""
+    frame_tree = thread_trace.frame_tree
+    index = frame_tree.find_path(frames)
+    if index < 0:
+        return None
+    zoomed_tree = FrameTree(frame_tree.symbols)
+    zoomed_tree.graft(-1, frame_tree, index)
+    return ThreadTrace.from_frame_tree(thread_trace.description, zoomed_tree)
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """Renders GET /report/path?thread=0&width=1200&zoom=frame;frame as SVG.
+
+    Report path is relative to server's root directory.  zoom is path of
+    frames below the thread's root frame in folded format, the last of them
+    becomes the root of rendered graph."""
+    # SVG is written in many small pieces.
+    wbufsize = 64 * 1024
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parameters = parse_qs(url.query)
+        report_path = self.server.resolve_path(unquote(url.path))
+        if report_path is None:
+            self.send_error(403, "Path outside of served directory")
+            return
+        if not os.path.isfile(report_path):
+            self.send_error(404, "Report not found")
+            return
+        try:
+            thread_number = int(parameters.get("thread", ["0"])[0])
+            width = int(parameters.get("width", [str(self.server.settings.total_width)])[0])
+        except ValueError:
+            self.send_error(400, "thread and width must be integers")
+            return
+        if width <= 0:
+            self.send_error(400, "width must be positive")
+            return
+        try:
+            threads = self.server.report_cache.get(report_path).process_trace.threads
+        except _REPORT_ERRORS:
+            self.send_error(422, "Report can't be parsed")
+            return
+        if not 0 <= thread_number < len(threads) or len(threads[thread_number].frame_tree) == 0:
+            self.send_error(404, "Thread not found")
+            return
+        thread_trace = threads[thread_number]
+        if "zoom" in parameters:
+            thread_trace = zoomed_thread_trace(thread_trace, parameters["zoom"][0].split(";"))
+            if thread_trace is None:
+                self.send_error(404, "Zoom frame not found")
+                return
+        settings = copy.copy(self.server.settings)
+        settings.total_width = width
+        compress = "gzip" in self.headers.get("Accept-Encoding", "")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/svg+xml; charset=utf-8")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        # Without Content-Length response ends when connection is closed, so it can be streamed.
+        if compress:
+            with gzip_stream(self.wfile) as compressed_stream:
+                write_thread_trace(UnicodeToBinaryStreamWrapper(compressed_stream), thread_trace, settings)
+        else:
+            write_thread_trace(UnicodeToBinaryStreamWrapper(self.wfile), thread_trace, settings)
+
+
+class RenderServer(HTTPServer):
+    """Serves flame graphs of reports in root_directory, requests are handled by a pool of threads."""
+    def __init__(self, address, root_directory, settings, report_cache, threads=None):
+        HTTPServer.__init__(self, address, RenderRequestHandler)
+        self.root_directory = os.path.realpath(root_directory)
+        self.settings = settings
+        self.report_cache = report_cache
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def resolve_path(self, url_path):
+        """Returns real path of file for url_path, None if it is outside of root directory."""
+        path = os.path.realpath(os.path.join(self.root_directory, url_path.lstrip("/")))
+        if not path.startswith(os.path.join(self.root_directory, "")):
+            return None
+        return path
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request_in_thread, request, client_address)
+
+    def _process_request_in_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self._executor.shutdown(wait=True)
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Renders spindump report as a flame graph SVG.")
+    parser.add_argument("filename", help="hang or spin report, or a directory or glob pattern with --batch; "
+                                         ".gz, .bz2 and .xz reports are decompressed")
+    parser.add_argument("--batch", action="store_true",
+                        help="merge all threads of all matching reports into a single graph")
+    parser.add_argument("--all-threads", action="store_true",
+                        help="render all threads one under another instead of the first thread only")
+    parser.add_argument("--output-dir",
+                        help="write a separate SVG file for every thread into this directory")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="number of worker processes for rendering threads (default: CPU count)")
+    parser.add_argument("--width", type=int, default=1200, help="image width")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write to FILE instead of stdout, output is compressed if FILE ends with .svgz")
+    parser.add_argument("--svgz", action="store_true",
+                        help="compress output with gzip, SVG files in --output-dir get .svgz extension")
+    parser.add_argument("--cache-dir",
+                        help="keep parsed reports in this directory, so they aren't parsed again")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="maximum total size of cached reports in megabytes (default: 1024)")
+    parser.add_argument("--folded", action="store_true",
+                        help="input contains stacks in folded format instead of a spindump report")
+    parser.add_argument("--write-folded", action="store_true",
+                        help="write stacks in folded format instead of SVG")
+    parser.add_argument("--min-width", type=float, default=0.1,
+                        help="omit frames narrower than this many pixels (default: 0.1)")
+    parser.add_argument("--merge-narrow", action="store_true",
+                        help="draw adjacent omitted frames as a single frame")
+    parser.add_argument("--stats", action="store_true",
+                        help="print time, counts and peak memory of every stage to stderr as JSON, "
+                             "work of worker processes isn't included unless --jobs 1 is used")
+    parser.add_argument("--stats-file", help="write stage statistics as JSON to this file")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="serve flame graphs of reports in directory filename over HTTP, "
+                             "e.g. GET /report.hang?thread=0&width=1200&zoom=frame;frame")
+    parser.add_argument("--host", default="127.0.0.1", help="address to serve on (default: 127.0.0.1)")
+    parser.add_argument("--memory-cache-size", type=int, default=512,
+                        help="maximum memory used by served reports in megabytes (default: 512)")
+    parser.add_argument("--diff", metavar="BEFORE",
+                        help="color frames by change in sample count since report BEFORE, "
+                             "red frames have more samples, blue frames have fewer; frames are "
+                             "compared without offsets and addresses, like with --normalize")
+    parser.add_argument("--normalize", action="store_true",
+                        help="merge frames of the same function called from one parent, "
+                             "ignoring offsets and addresses")
+    parser.add_argument("--collapse-recursion", action="store_true",
+                        help="merge directly recursive calls into their caller")
+    parser.add_argument("--reverse", action="store_true",
+                        help="draw callers tree: frames with self samples at the bottom, their callers above")
+    parser.add_argument("--highlight", metavar="REGEX",
+                        help="fill frames which names match regular expression with magenta")
+    parser.add_argument("--top", type=int, metavar="N",
+                        help="write N frames with the most self and inclusive samples instead of SVG")
+    parser.add_argument("--color-lut", action="store_true",
+                        help="quantize colors and share them through CSS classes, makes SVG smaller")
+    arguments = parser.parse_args(argv)
+    if arguments.jobs is not None and arguments.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if arguments.diff:
+        unsupported_options = [option for option, value in (
+            ("--batch", arguments.batch), ("--folded", arguments.folded), ("--cache-dir", arguments.cache_dir),
+            ("--all-threads", arguments.all_threads), ("--output-dir", arguments.output_dir),
+            ("--write-folded", arguments.write_folded), ("--top", arguments.top is not None),
+            ("--reverse", arguments.reverse)) if value]
+        if len(unsupported_options) > 0:
+            parser.error("--diff can't be used with %s" % ", ".join(unsupported_options))
+    return arguments
+
+
+def main():
+    arguments = parse_arguments(sys.argv[1:])
+    instrumentation = None
+    if arguments.stats or arguments.stats_file:
+        instrumentation = Instrumentation()
+        set_instrumentation(instrumentation)
+    try:
+        run(arguments)
+    finally:
+        if instrumentation is not None:
+            if arguments.stats:
+                instrumentation.write_json(sys.stderr)
+            if arguments.stats_file:
+                with io.open(arguments.stats_file, "wt") as stats_file:
+                    instrumentation.write_json(stats_file)
+
+
+def run(arguments):
+    settings = FlameGraphSettings(total_width=arguments.width)
+    settings.min_frame_width = arguments.min_width
+    settings.merge_narrow_frames = arguments.merge_narrow
+    if arguments.color_lut:
+        settings.color_lookup_steps = 256
+    settings.highlight = arguments.highlight
+    if arguments.serve is not None:
+        serve(arguments, settings)
+        return
+    # With --output-dir --svgz files are compressed, not stdout.
+    with open_output_stream(arguments.output, arguments.svgz and not arguments.output_dir) as output_stream:
+        write_output(arguments, settings, output_stream)
+
+
+def write_output(arguments, settings, output_stream):
+    if arguments.diff:
+        thread_trace = diff_reports(arguments.diff, arguments.filename,
+                                    collapse_recursion=arguments.collapse_recursion)
+        write_thread_trace(output_stream, thread_trace, settings)
+        return
+    if arguments.batch:
+        try:
+            thread_trace = merge_reports(iter_report_paths(arguments.filename), arguments.jobs)
+        except ValueError as error:
+            sys.exit("%s: %s" % (arguments.filename, error))
+        write_threads([thread_trace], arguments, settings, output_stream)
+        return
+    if arguments.folded:
+        with open_text_file(arguments.filename) as f:
+            thread_trace = ThreadTrace.from_folded(f, os.path.basename(arguments.filename))
+        write_threads([thread_trace], arguments, settings, output_stream)
+        return
+    if arguments.cache_dir:
+        cache = TraceCache(arguments.cache_dir, arguments.cache_size * 1024 * 1024)
+        report = cache.load_or_parse(arguments.filename)
+        write_threads(report.process_trace.threads, arguments, settings, output_stream)
+        return
+    # Parse threads as they are needed.
+    with open_report_parser(arguments.filename) as parser:
+        if _renders_in_pool(arguments):
+            # Workers parse threads themselves.
+            write_threads(parser.iter_thread_sections(), arguments, settings, output_stream)
+        else:
+            write_threads(parser.iter_thread_traces(), arguments, settings, output_stream)
+
+
+def _renders_in_pool(arguments):
+    """Returns True if threads are parsed and rendered by worker processes, see write_threads."""
+    return ((arguments.output_dir or arguments.all_threads) and arguments.jobs != 1 and
+            not (arguments.top is not None or arguments.write_folded or
+                 arguments.normalize or arguments.collapse_recursion or arguments.reverse))
+
+
+def serve(arguments, settings):
+    trace_cache = None
+    if arguments.cache_dir:
+        trace_cache = TraceCache(arguments.cache_dir, arguments.cache_size * 1024 * 1024)
+    report_cache = ReportCache(arguments.memory_cache_size * 1024 * 1024, trace_cache)
+    server = RenderServer((arguments.host, arguments.serve), arguments.filename, settings, report_cache,
+                          arguments.jobs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def write_threads(threads, arguments, settings, output_stream):
+    """Writes output requested by command line arguments.
+
+    threads are thread sections or already parsed ThreadTrace objects."""
+    threads = iter(threads)
+    if arguments.normalize or arguments.collapse_recursion:
+        threads = (as_thread_trace(thread).normalized(arguments.normalize, arguments.collapse_recursion)
+                   for thread in threads)
+    if arguments.reverse:
+        threads = (as_thread_trace(thread).inverted() for thread in threads)
+    if arguments.top is not None:
+        if arguments.all_threads:
+            frame_index = FrameIndex(as_thread_trace(thread).frame_tree for thread in threads)
+        else:
+            frame_index = as_thread_trace(next(threads)).frame_index()
+        write_hot_frames(output_stream, frame_index, arguments.top)
+    elif arguments.write_folded:
+        if not arguments.all_threads:
+            as_thread_trace(next(threads)).write_folded(output_stream)
+            return
+        # Distinguish threads by adding their description as the outermost frame.
+        for thread in threads:
+            thread_trace = as_thread_trace(thread)
+            thread_trace.write_folded(output_stream, thread_trace.description)
+    elif arguments.output_dir:
+        for _ in write_thread_sections(threads, settings, arguments.output_dir, arguments.jobs, arguments.svgz):
+            pass
+    elif arguments.all_threads:
+        # Total height is known only after all threads are rendered.
+        rendered_threads = render_thread_sections(threads, settings, arguments.jobs)
+        stack_thread_svgs(rendered_threads, settings).dump(output_stream)
+    else:
+        write_thread_trace(output_stream, as_thread_trace(next(threads)), settings)
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,19 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 from __future__ import unicode_literals
 import unittest
+import gzip
 import io
+import os
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import benchmark_flamegraph
 import flamegraph
+from urllib.error import HTTPError
+from urllib.parse import quote
+from urllib.request import Request, urlopen
 
 
 class TakeUntilEmptyLineTestCase(unittest.TestCase):
@@ -33,6 +43,165 @@ class TakeUntilEmptyLineTestCase(unittest.TestCase):
         self.assertIsNone(rest)
 
 
+REPORT_LINES = """Date/Time:       2013-08-30 20:32:27 +0300
+OS Version:      Mac OS X 10.8.4 (Build 12E55)
+
+Hardware model:  Macmini6,2
+
+Duration:        2.66s
+
+Fan speed:       1796 rpm
+
+Command:         Xcode
+PID:             55811
+
+  Thread 0x1a2b3     DispatchQueue 1     9 samples (1-9)
+  9 start + 1 (libdyld.dylib) [0x7fff8a7f95fd]
+    9 main + 34 (Xcode) [0x10d19ae72]
+      3 foo + 12 (Foo) [0x10d19b001]
+      4 bar + 5 (Foo) [0x10d19b002]
+        2 baz + 7 (Foo) [0x10d19b003]
+
+  Thread 0x1a2b4     5 samples (1-5)
+  5 thread_start + 13 (libsystem_c.dylib) [0x7fff8ea77fe1]
+    5 mach_msg_trap + 10 (libsystem_kernel.dylib) [0x7fff8ea77fe2]
+
+  Binary Images:
+         0x10d19a000 -        0x10d19afff  com.apple.dt.Xcode 4.6.3 (2111) /Applications/Xcode.app
+
+Other: not a part of the process
+""".splitlines()
+THREAD_LINES = REPORT_LINES[12:18]
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    """Base of test cases with files, every test gets a new temporary directory."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_report(self, name, lines=REPORT_LINES):
+        path = os.path.join(self.directory, name)
+        with io.open(path, "wt") as report_file:
+            report_file.write("\n".join(lines))
+        return path
+
+
+class IterSectionsTestCase(unittest.TestCase):
+    def test_trivial(self):
+        actual = list(flamegraph.iter_sections(["a", "", "b", "c"]))
+        self.assertEqual(actual, [["a"], ["b", "c"]])
+
+    def test_few_empty_lines(self):
+        actual = list(flamegraph.iter_sections(["", "a", "", "", "b", ""]))
+        self.assertEqual(actual, [["a"], ["b"]])
+
+    def test_strips_newlines(self):
+        actual = list(flamegraph.iter_sections(io.StringIO("a\r\nb\n\nc\n")))
+        self.assertEqual(actual, [["a", "b"], ["c"]])
+
+
+class TraceReportTestCase(unittest.TestCase):
+    def test_report(self):
+        report = flamegraph.TraceReport(REPORT_LINES)
+        self.assertEqual(len(report.report_attributes), 4)
+        self.assertEqual(report.report_attributes[1], [("Hardware model", "Macmini6,2")])
+        self.assertEqual(report.process_trace.attributes, [("Command", "Xcode"), ("PID", "55811")])
+        threads = report.process_trace.threads
+        self.assertEqual(len(threads), 2)
+        self.assertEqual(threads[0].description, "Thread 0x1a2b3     DispatchQueue 1     9 samples (1-9)")
+        self.assertEqual(threads[0].max_stack_depth(), 4)
+        self.assertEqual(threads[1].root_frame.frame, "thread_start + 13 (libsystem_c.dylib) [0x7fff8ea77fe1]")
+
+    def test_threads_share_symbols(self):
+        report = flamegraph.TraceReport(REPORT_LINES[:22] + [""] + THREAD_LINES + REPORT_LINES[22:])
+        threads = report.process_trace.threads
+        self.assertEqual(len(threads), 3)
+        for thread in threads:
+            self.assertIs(thread.frame_tree.symbols, report.process_trace.symbols)
+        self.assertEqual(list(threads[2].frame_tree.frame_ids), list(threads[0].frame_tree.frame_ids))
+        self.assertEqual(len(report.process_trace.symbols), 7)
+
+    def test_file_object(self):
+        report = flamegraph.TraceReport(io.StringIO("\n".join(REPORT_LINES)))
+        self.assertEqual(len(report.process_trace.threads), 2)
+
+    def test_streaming_threads(self):
+        parser = flamegraph.TraceReportParser(iter(REPORT_LINES))
+        threads = parser.iter_thread_traces()
+        first_thread = next(threads)
+        self.assertEqual(first_thread.root_frame.sample_count, 9)
+        self.assertEqual([child.sample_count for child in first_thread.root_frame.child_samples], [9])
+        self.assertEqual([thread.root_frame.sample_count for thread in threads], [5])
+
+
+class MappedTraceReportParserTestCase(TemporaryDirectoryTestCase):
+    def assertSameThreads(self, actual_threads, expected_threads):
+        self.assertEqual([thread.description for thread in actual_threads],
+                         [thread.description for thread in expected_threads])
+        self.assertEqual([list(thread.frame_tree.iter_folded_stacks()) for thread in actual_threads],
+                         [list(thread.frame_tree.iter_folded_stacks()) for thread in expected_threads])
+
+    def test_same_as_line_parser(self):
+        expected = flamegraph.TraceReportParser(REPORT_LINES)
+        for newline in ("\n", "\r\n"):
+            parser = flamegraph.MappedTraceReportParser(newline.join(REPORT_LINES).encode("utf-8"))
+            self.assertEqual(parser.report_attributes, expected.report_attributes)
+            self.assertEqual(parser.process_attributes, expected.process_attributes)
+            self.assertSameThreads(list(parser.iter_thread_traces()),
+                                   list(flamegraph.TraceReportParser(REPORT_LINES).iter_thread_traces()))
+        self.assertEqual(len(parser.symbols), 7)
+
+    def test_kernel_frames(self):
+        # Kernel frames are marked with "*" before sample count.
+        lines = REPORT_LINES[:17] + ["     *2 ipc_mqueue_receive + 5 (mach_kernel) [0xffffff80002f]",
+                                     "       *2 thread_block + 1 (mach_kernel) [0xffffff800030]"] + REPORT_LINES[17:]
+        expected = list(flamegraph.TraceReportParser(lines).iter_thread_traces())
+        actual = list(flamegraph.MappedTraceReportParser("\n".join(lines).encode("utf-8")).iter_thread_traces())
+        self.assertSameThreads(actual, expected)
+        self.assertIn("thread_block + 1 (mach_kernel) [0xffffff800030]", actual[0].frame_tree.symbols.names)
+
+    def test_thread_sections(self):
+        with flamegraph.MappedTraceReportParser.open(self.write_report("a.hang")) as parser:
+            sections = list(parser.iter_thread_sections())
+        threads = [flamegraph.as_thread_trace(section) for section in sections]
+        svgs = list(flamegraph.render_thread_sections(sections, flamegraph.FlameGraphSettings(), jobs=2))
+        self.assertSameThreads(threads, flamegraph.TraceReport(REPORT_LINES).process_trace.threads)
+        self.assertEqual([description for description, _ in svgs], [thread.description for thread in threads])
+
+    def test_memory_doesnt_grow_with_section_size(self):
+        report_file = io.StringIO()
+        benchmark_flamegraph.generate_spindump(report_file, 20000, thread_count=1)
+        buffer = report_file.getvalue().encode("utf-8")
+        tracemalloc.start()
+        try:
+            parser = flamegraph.MappedTraceReportParser(buffer)
+            thread_trace, = parser.iter_thread_traces()
+            _, peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # Parsing needs little more than the frame tree itself, not memory per line.
+        self.assertLess(peak_bytes, 2 * thread_trace.frame_tree.memory_size() + 256 * 1024)
+
+    def test_malformed_line(self):
+        lines = REPORT_LINES[:17] + ["      no sample count"] + REPORT_LINES[17:]
+        parser = flamegraph.MappedTraceReportParser("\n".join(lines).encode("utf-8"))
+        with self.assertRaises(AssertionError):
+            list(parser.iter_thread_traces())
+
+    def test_file(self):
+        report = flamegraph.TraceReport.from_file(self.write_report("a.hang", REPORT_LINES[:22] + [""] + THREAD_LINES))
+        self.assertSameThreads(report.process_trace.threads, flamegraph.TraceReport(
+            REPORT_LINES[:22] + [""] + THREAD_LINES).process_trace.threads)
+        self.assertEqual(report.report_attributes[1], [("Hardware model", "Macmini6,2")])
+
+    def test_truncated(self):
+        with self.assertRaises(AssertionError):
+            flamegraph.MappedTraceReportParser(b"Date/Time: now\n\nOS Version: 10.8\n")
+
+
 class SplitOnColonTestCase(unittest.TestCase):
     def test_trivial(self):
         actual = flamegraph.split_on_colon(["a: b"])
@@ -45,6 +214,106 @@ class SplitOnColonTestCase(unittest.TestCase):
         self.assertEqual(actual, [("PID", "55811"), ("Event", "hang")])
 
 
+class NormalizeTestCase(unittest.TestCase):
+    def test_merge_siblings(self):
+        tree = flamegraph.FrameTree.from_folded([
+            "main + 1 (App) [0x10];foo + 4 (Lib) [0x20];bar + 1 (Lib) [0x30] 3",
+            "main + 1 (App) [0x10];foo + 8 (Lib) [0x24];bar + 1 (Lib) [0x30] 2",
+            "main + 1 (App) [0x10];foo + 8 (Lib) [0x24] 1",
+            "main + 1 (App) [0x10];baz 4"])
+        normalized = flamegraph.normalize_frame_tree(tree)
+        self.assertEqual(list(normalized.iter_folded_stacks()),
+                         ["main (App);foo (Lib) 1", "main (App);foo (Lib);bar (Lib) 5", "main (App);baz 4"])
+        self.assertEqual(list(normalized.heights), [3, 2, 1, 1])
+        # Without stripping addresses only equal names are merged.
+        self.assertEqual(len(flamegraph.normalize_frame_tree(tree, strip_addresses=False)), 6)
+
+    def test_collapse_recursion(self):
+        tree = flamegraph.FrameTree.from_folded(["a;r;r;r;x 3", "a;r;r;y 2", "a;r;x 1", "a;r;a 1"])
+        normalized = flamegraph.normalize_frame_tree(tree, collapse_recursion=True)
+        self.assertEqual(sorted(normalized.iter_folded_stacks()), ["a;r;a 1", "a;r;x 4", "a;r;y 2"])
+        self.assertEqual(normalized.sample_counts[0], 7)
+        thread_trace = flamegraph.ThreadTrace.from_frame_tree("thread", tree)
+        self.assertEqual(thread_trace.normalized(collapse_recursion=True).max_stack_depth(), 3)
+        self.assertEqual(thread_trace.max_stack_depth(), 5)
+
+
+class InvertTestCase(unittest.TestCase):
+    def test_invert(self):
+        tree = flamegraph.FrameTree.from_folded(["a;b;c 3", "a;b 2", "a;d;c 1", "a 1"])
+        inverted = flamegraph.invert_frame_tree(tree)
+        self.assertEqual(list(inverted.iter_folded_stacks()),
+                         ["all;a 1", "all;b;a 2", "all;c;b;a 3", "all;c;d;a 1"])
+        self.assertEqual(inverted.sample_counts[0], 7)
+        self.assertEqual(inverted.heights[0], 4)
+
+    def test_thread_trace(self):
+        thread_trace = flamegraph.ThreadTrace(THREAD_LINES).inverted()
+        root_frame = thread_trace.root_frame
+        self.assertEqual(root_frame.frame, "all")
+        self.assertEqual([(child.frame, child.sample_count) for child in root_frame.child_samples],
+                         [("main + 34 (Xcode) [0x10d19ae72]", 2), ("foo + 12 (Foo) [0x10d19b001]", 3),
+                          ("bar + 5 (Foo) [0x10d19b002]", 2), ("baz + 7 (Foo) [0x10d19b003]", 2)])
+        self.assertEqual(thread_trace.max_stack_depth(), 5)
+
+
+class FrameIndexTestCase(unittest.TestCase):
+    def test_sample_counts(self):
+        # a is recursive, its inclusive samples must not be counted twice.
+        tree = flamegraph.FrameTree.from_folded(["a;b;a;c 4", "a;b 2", "a;d 3", "a 1"])
+        frame_index = flamegraph.FrameIndex([tree])
+        self.assertEqual(frame_index.top(2), [("c", 4), ("d", 3)])
+        self.assertEqual(frame_index.top(5, inclusive=True),
+                         [("a", 10), ("b", 6), ("c", 4), ("d", 3)])
+        self.assertEqual(sorted(frame_index.top(5)), [("a", 1), ("b", 2), ("c", 4), ("d", 3)])
+
+    def test_search(self):
+        thread_trace = flamegraph.ThreadTrace(THREAD_LINES)
+        frame_index = thread_trace.frame_index()
+        self.assertIs(thread_trace.frame_index(), frame_index)
+        frame_ids = frame_index.search(r"\(Foo\)")
+        self.assertEqual(sorted(thread_trace.frame_tree.frame(index) for index in frame_index.nodes(frame_ids)),
+                         ["bar + 5 (Foo) [0x10d19b002]", "baz + 7 (Foo) [0x10d19b003]",
+                          "foo + 12 (Foo) [0x10d19b001]"])
+        # bar contains baz, its samples are counted once.
+        self.assertEqual(frame_index.matched_sample_count(frame_ids), 7)
+
+    def test_matched_sample_count_of_merged_tree(self):
+        # Node indices of merged trees aren't in the order of starts.
+        # x is added after b, but it is to the left of b.
+        tree = flamegraph.merge_frame_trees([flamegraph.FrameTree.from_folded(["r;a 3", "r;b 5"]),
+                                             flamegraph.FrameTree.from_folded(["r;a;x 2"])])
+        self.assertLess(tree.starts[tree.find_path(["r", "a", "x"])], tree.starts[tree.find_path(["r", "b"])])
+        frame_index = flamegraph.FrameIndex([tree])
+        self.assertEqual(frame_index.matched_sample_count(frame_index.search("^[bx]$")), 7)
+
+    def test_process_trace(self):
+        report = flamegraph.TraceReport(REPORT_LINES)
+        frame_index = report.process_trace.frame_index()
+        self.assertEqual(frame_index.inclusive_sample_counts[frame_index.symbols.find(
+            "thread_start + 13 (libsystem_c.dylib) [0x7fff8ea77fe1]")], 5)
+        self.assertEqual(frame_index.top(1), [("mach_msg_trap + 10 (libsystem_kernel.dylib) [0x7fff8ea77fe2]", 5)])
+        self.assertEqual(frame_index.nodes(frame_index.search("mach_msg_trap"), tree_number=1), [1])
+
+    def test_highlight(self):
+        settings = flamegraph.FlameGraphSettings()
+        settings.highlight = "^ba[rz]"
+        svg = flamegraph.render_thread_trace(flamegraph.ThreadTrace(THREAD_LINES), settings)
+        rects = [line for line in svg.content_lines if line.startswith("<rect")]
+        self.assertEqual([settings.highlight_color in rect for rect in rects],
+                         [False, False, False, True, True])
+        settings.color_lookup_steps = 16
+        svg = flamegraph.render_thread_trace(flamegraph.ThreadTrace(THREAD_LINES), settings)
+        self.assertIn(".c230_0_230{fill:rgb(230, 0, 230)}", svg.content_lines[1])
+        self.assertEqual(len([line for line in svg.content_lines if 'class="c230_0_230"' in line]), 2)
+
+    def test_write_hot_frames(self):
+        stream = io.StringIO()
+        flamegraph.write_hot_frames(stream, flamegraph.FrameIndex([flamegraph.FrameTree.from_folded(["a;b 2"])]), 1)
+        self.assertEqual(stream.getvalue(), "Self samples:\n         2  b\n\n"
+                                            "Inclusive samples:\n         2  a\n\n")
+
+
 class FrameSampleTestCase(unittest.TestCase):
     def test_height(self):
         parent = flamegraph.FrameSample("parent + 1 (Foo) [0x7fff80004444]", 9)
@@ -74,6 +343,82 @@ class FrameSampleTestCase(unittest.TestCase):
                           ("grand_child_b + 1 (Foo) [0x7fff80004444]", 3, 2)]
         self.assertEqual(actual_items, expected_items)
 
+    def test_add_after_adding_to_parent(self):
+        parent = flamegraph.FrameSample("parent", 4)
+        child = flamegraph.FrameSample("child", 4)
+        grand_child = flamegraph.FrameSample("grand_child", 3)
+        leaf = flamegraph.FrameSample("leaf", 1)
+        child.add_child_sample(grand_child)
+        parent.add_child_sample(child)
+        grand_child.add_child_sample(leaf)
+        self.assertEqual(parent.height(), 4)
+        self.assertEqual([(frame.frame, start, depth) for frame, start, depth in parent.iteritems()],
+                         [("parent", 0, 0), ("child", 0, 1), ("grand_child", 0, 2), ("leaf", 0, 3)])
+        self.assertIs(leaf.tree, parent.tree)
+
+    def test_build_bottom_up(self):
+        frame_samples = [flamegraph.FrameSample("frame %d" % depth, 1) for depth in range(1000)]
+        for parent, child in reversed(list(zip(frame_samples, frame_samples[1:]))):
+            parent.add_child_sample(child)
+        self.assertEqual(frame_samples[0].height(), 1000)
+        self.assertEqual(len(frame_samples[0].tree), 1000)
+        self.assertEqual(frame_samples[-1].child_samples, [])
+        self.assertEqual(frame_samples[500].child_samples[0].frame, "frame 501")
+
+
+class FrameTreeTestCase(unittest.TestCase):
+    def test_thread_trace_columns(self):
+        thread_trace = flamegraph.ThreadTrace(THREAD_LINES)
+        tree = thread_trace.frame_tree
+        self.assertEqual(list(tree.parents), [-1, 0, 1, 1, 3])
+        self.assertEqual(list(tree.depths), [0, 1, 2, 2, 3])
+        self.assertEqual(list(tree.starts), [0, 0, 0, 3, 3])
+        self.assertEqual(list(tree.sample_counts), [9, 9, 3, 4, 2])
+        self.assertEqual(list(tree.heights), [4, 3, 1, 2, 1])
+        self.assertEqual(tree.frame(4), "baz + 7 (Foo) [0x10d19b003]")
+
+    def test_extend_preorder(self):
+        expected = flamegraph.ThreadTrace(THREAD_LINES).frame_tree
+        tree = flamegraph.FrameTree(expected.symbols)
+        tree.extend_preorder((expected.depths[index], expected.frame_ids[index], expected.sample_counts[index])
+                             for index in range(len(expected)))
+        for column_name in flamegraph.FrameTree.COLUMN_NAMES:
+            self.assertEqual(getattr(tree, column_name), getattr(expected, column_name))
+
+    def test_with_own_symbols(self):
+        report = flamegraph.TraceReport(REPORT_LINES)
+        thread_trace = report.process_trace.threads[1].with_own_symbols()
+        self.assertEqual(len(thread_trace.frame_tree.symbols), 2)
+        self.assertEqual(list(thread_trace.frame_tree.iter_folded_stacks()),
+                         list(report.process_trace.threads[1].frame_tree.iter_folded_stacks()))
+
+    def test_deep_stack(self):
+        depth = 2000
+        trace_lines = ["  Thread 0x1"]
+        trace_lines.extend("  " * (level + 1) + "7 recursive + 1 (Foo)" for level in range(depth))
+        thread_trace = flamegraph.ThreadTrace(trace_lines)
+        self.assertEqual(thread_trace.max_stack_depth(), depth)
+        items = list(thread_trace.root_frame.iteritems())
+        self.assertEqual(len(items), depth)
+        self.assertEqual(items[-1][1:], (0, depth - 1))
+
+    def test_interned_frames(self):
+        tree = flamegraph.FrameTree()
+        root = tree.add_node(-1, "recursive", 5)
+        child = tree.add_node(root, "recursive", 4)
+        tree.add_node(child, "leaf", 4)
+        self.assertEqual(list(tree.frame_ids), [0, 0, 1])
+        self.assertEqual(tree.symbols.names, ["recursive", "leaf"])
+
+    def test_frame_sample_view(self):
+        tree = flamegraph.FrameTree()
+        root = tree.add_node(-1, "root", 5)
+        tree.add_node(root, "child", 3)
+        root_sample = tree.sample(root)
+        self.assertEqual(root_sample.frame, "root")
+        self.assertEqual([child.frame for child in root_sample.child_samples], ["child"])
+        self.assertIs(root_sample.child_samples[0].tree, tree)
+
 
 class SVGTestCase(unittest.TestCase):
     def full_svg_dump(self, svg):
@@ -106,6 +451,13 @@ version="1.1" xmlns="http://www.w3.org/2000/svg">
         expected_svg = '<rect x="23.2" y="76.8" width="45.0" height="54.0" fill="rgb(100,100,100)" rx="2" ry="2" />'
         self.assertEqual(expected_svg, actual_svg)
 
+    def test_add_rect_with_css_class(self):
+        svg = flamegraph.SVG(100, 100)
+        svg.add_rect(23.23, 76.76, 45, 54, None, css_class="c1_2_3")
+        actual_svg = self.short_svg_dump(svg)
+        expected_svg = '<rect x="23.2" y="76.8" width="45.0" height="54.0" class="c1_2_3" rx="2" ry="2" />'
+        self.assertEqual(expected_svg, actual_svg)
+
     def test_add_text(self):
         svg = flamegraph.SVG(100, 100)
         svg.add_text("foo", 12.34, 56.78)
@@ -127,5 +479,562 @@ version="1.1" xmlns="http://www.w3.org/2000/svg">
         expected_svg = '<text x="12.3" y="56.8" font-size="12" font-family="Helvetica">\u2026</text>'
         self.assertEqual(expected_svg, actual_svg)
 
+
+class ColorRectInterpolatorTestCase(unittest.TestCase):
+    def test_batch_matches_single_colors(self):
+        interpolator = flamegraph.FlameGraphSettings().color_interpolator
+        positions = [(x / 10., y / 7.) for x in range(11) for y in range(8)]
+        expected = [interpolator.color_at_pos(x, y).rgb_string() for x, y in positions]
+        self.assertEqual(interpolator.rgb_strings_at_positions(positions), expected)
+
+
+class ColorLookupTableTestCase(unittest.TestCase):
+    def test_cached_lookup_table(self):
+        settings = flamegraph.FlameGraphSettings()
+        lookup_table = flamegraph.cached_lookup_table(settings.color_interpolator, 16, 5)
+        # Interpolators with equal colors share tables.
+        other_settings = flamegraph.FlameGraphSettings()
+        self.assertIs(flamegraph.cached_lookup_table(other_settings.color_interpolator, 16, 5), lookup_table)
+        self.assertIsNot(flamegraph.cached_lookup_table(settings.color_interpolator, 16, 6), lookup_table)
+        self.assertEqual(lookup_table.fills, settings.color_interpolator.lookup_table(16, 5).fills)
+
+    def test_grid_points_are_exact(self):
+        interpolator = flamegraph.FlameGraphSettings().color_interpolator
+        lookup_table = interpolator.lookup_table(11, 5)
+        for x_pos, y_pos in [(0., 0.), (0.3, 0.25), (1., 1.), (0.7, 0.5)]:
+            self.assertEqual(lookup_table.fill_at_pos(x_pos, y_pos),
+                             interpolator.color_at_pos(x_pos, y_pos).rgb_string())
+
+    def test_quantization(self):
+        interpolator = flamegraph.FlameGraphSettings().color_interpolator
+        lookup_table = interpolator.lookup_table(11, 5)
+        self.assertEqual(lookup_table.fill_at_pos(0.31, 0.27), lookup_table.fill_at_pos(0.3, 0.25))
+        self.assertEqual(lookup_table.css_class_at_pos(0.31, 0.27), lookup_table.css_class_at_pos(0.3, 0.25))
+
+    def test_one_dimensional_table(self):
+        interpolator = flamegraph.ColorInterpolator(flamegraph.Color.rgb(0xff, 0xed, 0xa0),
+                                                    flamegraph.Color.rgb(0xf0, 0x3b, 0x20))
+        lookup_table = interpolator.lookup_table(5)
+        self.assertEqual(lookup_table.fill_at_pos(0.5), interpolator.color_at_pos(0.5).rgb_string())
+
+    def test_stylesheet(self):
+        lookup_table = flamegraph.ColorLookupTable(["rgb(1, 2, 3)", "rgb(1, 2, 3)", "rgb(4, 5, -6)"], 3, 1)
+        self.assertEqual(lookup_table.css_class_at_pos(0.), "c1_2_3")
+        self.assertEqual(lookup_table.stylesheet(),
+                         ".c1_2_3{fill:rgb(1, 2, 3)}.c4_5_-6{fill:rgb(4, 5, -6)}")
+
+
+class FoldedStacksTestCase(unittest.TestCase):
+    FOLDED_LINES = ["start + 1 (libdyld.dylib) [0x7fff8a7f95fd];main + 34 (Xcode) [0x10d19ae72] 2",
+                    "start + 1 (libdyld.dylib) [0x7fff8a7f95fd];main + 34 (Xcode) [0x10d19ae72];"
+                    "foo + 12 (Foo) [0x10d19b001] 3",
+                    "start + 1 (libdyld.dylib) [0x7fff8a7f95fd];main + 34 (Xcode) [0x10d19ae72];"
+                    "bar + 5 (Foo) [0x10d19b002] 2",
+                    "start + 1 (libdyld.dylib) [0x7fff8a7f95fd];main + 34 (Xcode) [0x10d19ae72];"
+                    "bar + 5 (Foo) [0x10d19b002];baz + 7 (Foo) [0x10d19b003] 2"]
+
+    def test_export(self):
+        thread_trace = flamegraph.ThreadTrace(THREAD_LINES)
+        self.assertEqual(list(thread_trace.frame_tree.iter_folded_stacks()), self.FOLDED_LINES)
+
+    def test_export_with_prefix(self):
+        string_buffer = io.StringIO()
+        flamegraph.ThreadTrace(THREAD_LINES).write_folded(string_buffer, "Thread;1")
+        self.assertTrue(string_buffer.getvalue().startswith("Thread:1;start + 1"))
+        self.assertEqual(len(string_buffer.getvalue().splitlines()), 4)
+
+    def test_import(self):
+        thread_trace = flamegraph.ThreadTrace.from_folded(self.FOLDED_LINES, "folded")
+        expected_trace = flamegraph.ThreadTrace(THREAD_LINES)
+        self.assertEqual([(frame.frame, frame.sample_count, start, depth)
+                          for frame, start, depth in thread_trace.root_frame.iteritems()],
+                         [(frame.frame, frame.sample_count, start, depth)
+                          for frame, start, depth in expected_trace.root_frame.iteritems()])
+        self.assertEqual(thread_trace.description, "folded")
+        self.assertEqual(thread_trace.max_stack_depth(), 4)
+
+    def test_import_merges_prefixes(self):
+        thread_trace = flamegraph.ThreadTrace.from_folded(["a;b 1", "a;b 2", "a;c 3", "", "a;b;d 4"], "folded")
+        tree = thread_trace.frame_tree
+        self.assertEqual([tree.frame(index) for index in range(len(tree))], ["a", "b", "d", "c"])
+        self.assertEqual(list(tree.sample_counts), [10, 7, 4, 3])
+        self.assertEqual(list(tree.starts), [0, 0, 0, 7])
+
+    def test_import_several_roots(self):
+        tree = flamegraph.FrameTree.from_folded(["a;b 1", "c 2"])
+        self.assertEqual(tree.frame(0), "all")
+        self.assertEqual(tree.sample_counts[0], 3)
+        self.assertEqual(list(tree.heights), [3, 2, 1, 1])
+
+
+class FrameTreeMergerTestCase(TemporaryDirectoryTestCase):
+    def test_merge_threads(self):
+        report = flamegraph.TraceReport(REPORT_LINES[:22] + [""] + THREAD_LINES + REPORT_LINES[22:])
+        tree = flamegraph.merge_frame_trees(thread.frame_tree for thread in report.process_trace.threads)
+        self.assertEqual(sorted(tree.iter_folded_stacks()), sorted(
+            ["all;" + line.rsplit(" ", 1)[0] + " " + str(2 * int(line.rsplit(" ", 1)[1]))
+             for line in FoldedStacksTestCase.FOLDED_LINES] +
+            ["all;thread_start + 13 (libsystem_c.dylib) [0x7fff8ea77fe1];"
+             "mach_msg_trap + 10 (libsystem_kernel.dylib) [0x7fff8ea77fe2] 5"]))
+        self.assertEqual(tree.sample_counts[0], 23)
+        self.assertEqual(len(tree), 8)
+
+    def test_different_symbol_tables(self):
+        first = flamegraph.FrameTree.from_folded(["a;b 1", "a;c 2"])
+        second = flamegraph.FrameTree.from_folded(["x 4", "a;c 3"])
+        merger = flamegraph.FrameTreeMerger()
+        merger.add(first)
+        mapping = merger.add_into(second, 0, merger.root)
+        tree = merger.finish()
+        self.assertEqual(sorted(tree.iter_folded_stacks()), ["all;a;b 1", "all;a;c 5", "all;x 4"])
+        self.assertEqual([tree.frame(index) for index in mapping], ["all", "x", "a", "c"])
+
+    def test_merge_reports(self):
+        self.write_report("a.hang")
+        self.write_report("b.hang")
+        paths = list(flamegraph.iter_report_paths(self.directory))
+        self.assertEqual([os.path.basename(path) for path in paths], ["a.hang", "b.hang"])
+        self.assertEqual(list(flamegraph.iter_report_paths(os.path.join(self.directory, "a.*"))), paths[:1])
+        thread_trace = flamegraph.merge_reports(paths, jobs=2)
+        self.assertEqual(thread_trace.description, "2 reports")
+        self.assertEqual(thread_trace.root_frame.sample_count, 28)
+        self.assertEqual([child.sample_count for child in thread_trace.root_frame.child_samples], [18, 10])
+        self.assertEqual(thread_trace.max_stack_depth(), 5)
+
+    def test_merge_reports_skips_other_files(self):
+        self.write_report("a.hang")
+        other_paths = [self.write_report("README", ["Hang reports of the nightly run", ""]),
+                       os.path.join(self.directory, "truncated.hang.gz")]
+        with io.open(other_paths[1], "wb") as compressed_file:
+            compressed_file.write(gzip.compress("\n".join(REPORT_LINES).encode("utf-8"))[:100])
+        thread_trace = flamegraph.merge_reports(flamegraph.iter_report_paths(self.directory), jobs=1)
+        with self.assertRaises(ValueError):
+            flamegraph.merge_reports(other_paths, jobs=1)
+        with self.assertRaises(ValueError):
+            flamegraph.merge_reports(flamegraph.iter_report_paths(os.path.join(self.directory, "*.spin")), jobs=1)
+        self.assertEqual(thread_trace.description, "1 reports")
+        self.assertEqual(thread_trace.root_frame.sample_count, 14)
+
+
+class DiffTestCase(TemporaryDirectoryTestCase):
+    def test_diff_frame_trees(self):
+        before = flamegraph.FrameTree.from_folded(["a;b 4", "a;c 2", "x 3", "a 1"])
+        after = flamegraph.FrameTree.from_folded(["a;b 1", "a;c 2", "a;d 5", "a 1", "y 1"])
+        deltas = flamegraph.diff_frame_trees(before, after)
+        self.assertEqual(dict((after.frame(index), deltas[index]) for index in range(len(after))),
+                         {"all": 0, "a": 2, "b": -3, "c": 0, "d": 5, "y": 1})
+
+    def test_diff_reports_ignore_addresses(self):
+        before_path = self.write_report("before.hang")
+        # The same report with addresses shifted, as with address space layout randomization.
+        after_path = self.write_report("after.hang", [line.replace("[0x10d19", "[0x10d1a") for line in REPORT_LINES])
+        thread_trace = flamegraph.diff_reports(before_path, after_path)
+        self.assertEqual(set(thread_trace.sample_deltas), set([0]))
+        self.assertEqual(thread_trace.root_frame.child_samples[0].frame, "start (libdyld.dylib)")
+
+    def test_unsupported_options(self):
+        with self.assertRaises(SystemExit):
+            flamegraph.parse_arguments(["--diff", "before.hang", "--reverse", "after.hang"])
+        self.assertTrue(flamegraph.parse_arguments(["--diff", "before.hang", "--collapse-recursion", "after.hang"]).diff)
+
+    def test_render_diff(self):
+        before = flamegraph.FrameTree.from_folded(["a;b 4", "a;c 2"])
+        after = flamegraph.FrameTree.from_folded(["a;b 2", "a;c 4"])
+        thread_trace = flamegraph.ThreadTrace.from_frame_tree("diff", after)
+        thread_trace.sample_deltas = flamegraph.diff_frame_trees(before, after)
+        settings = flamegraph.FlameGraphSettings()
+        rects = [line for line in flamegraph.render_thread_trace(thread_trace, settings).content_lines
+                 if line.startswith("<rect")]
+        # a, b, c; b is the most blue and c is the most red.
+        self.assertEqual([rect.split('fill="')[1].split('"')[0] for rect in rects],
+                         ["rgb(240, 240, 240)", "rgb(69, 117, 180)", "rgb(214, 48, 39)"])
+        settings.color_lookup_steps = 16
+        svg = flamegraph.render_thread_trace(thread_trace, settings)
+        self.assertEqual(svg.content_lines[0],
+                         '<style type="text/css">.c240_240_240{fill:rgb(240, 240, 240)}.c69_117_180{fill:rgb(69, 117, 180)}'
+                         '.c214_48_39{fill:rgb(214, 48, 39)}</style>')
+
+
+class TraceCacheTestCase(TemporaryDirectoryTestCase):
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.cache_directory = os.path.join(self.directory, "cache")
+
+    def test_round_trip(self):
+        path = self.write_report("a.hang")
+        cache = flamegraph.TraceCache(self.cache_directory)
+        parsed_report = cache.load_or_parse(path)
+        entry_path = cache.entry_path(path)
+        self.assertTrue(os.path.exists(entry_path))
+        cached_report = cache.load(entry_path)
+        self.assertEqual(cached_report.report_attributes, parsed_report.report_attributes)
+        self.assertEqual(cached_report.process_trace.attributes, parsed_report.process_trace.attributes)
+        self.assertEqual(len(cached_report.process_trace.threads), 2)
+        for cached_thread, parsed_thread in zip(cached_report.process_trace.threads,
+                                                parsed_report.process_trace.threads):
+            self.assertEqual(cached_thread.description, parsed_thread.description)
+            for column_name in flamegraph.FrameTree.COLUMN_NAMES:
+                self.assertEqual(getattr(cached_thread.frame_tree, column_name),
+                                 getattr(parsed_thread.frame_tree, column_name))
+            self.assertEqual(list(cached_thread.frame_tree.iter_folded_stacks()),
+                             list(parsed_thread.frame_tree.iter_folded_stacks()))
+
+    def test_key_depends_on_content(self):
+        cache = flamegraph.TraceCache(self.cache_directory)
+        first_path = self.write_report("a.hang")
+        same_path = self.write_report("b.hang")
+        other_path = self.write_report("c.hang", REPORT_LINES[:-1])
+        self.assertEqual(cache.entry_path(first_path), cache.entry_path(same_path))
+        self.assertNotEqual(cache.entry_path(first_path), cache.entry_path(other_path))
+
+    def test_corrupted_entry(self):
+        path = self.write_report("a.hang")
+        cache = flamegraph.TraceCache(self.cache_directory)
+        with io.open(cache.entry_path(path), "wb") as entry_file:
+            entry_file.write(b"FGCACHE1\x10")
+        self.assertIsNone(cache.load(cache.entry_path(path)))
+        self.assertEqual(len(cache.load_or_parse(path).process_trace.threads), 2)
+
+    def test_eviction(self):
+        first_path = self.write_report("a.hang")
+        second_path = self.write_report("b.hang", REPORT_LINES[:-1])
+        cache = flamegraph.TraceCache(self.cache_directory)
+        cache.load_or_parse(first_path)
+        entry_size = os.path.getsize(cache.entry_path(first_path))
+        cache.max_size = entry_size + entry_size // 2
+        os.utime(cache.entry_path(first_path), (1, 1))
+        cache.load_or_parse(second_path)
+        self.assertFalse(os.path.exists(cache.entry_path(first_path)))
+        self.assertTrue(os.path.exists(cache.entry_path(second_path)))
+
+    def test_eviction_skips_removed_entries(self):
+        path = self.write_report("a.hang")
+        cache = flamegraph.TraceCache(self.cache_directory, max_size=0)
+        listdir = os.listdir
+        # An entry listed, but removed by another process before it is examined.
+        os.listdir = lambda directory: listdir(directory) + ["removed.fgcache"]
+        try:
+            self.assertEqual(len(cache.load_or_parse(path).process_trace.threads), 2)
+        finally:
+            os.listdir = listdir
+        self.assertEqual(os.listdir(self.cache_directory), [])
+
+
+class VisibleFramesTestCase(unittest.TestCase):
+    def make_tree(self):
+        tree = flamegraph.FrameTree()
+        root = tree.add_node(-1, "root", 100)
+        tree.add_node(root, "wide", 90)
+        narrow = tree.add_node(root, "narrow_a", 4)
+        tree.add_node(narrow, "narrow_child", 4)
+        tree.add_node(root, "narrow_b", 3)
+        return tree
+
+    def test_all_frames(self):
+        actual = list(flamegraph.iter_visible_frames(self.make_tree(), 0))
+        self.assertEqual([index for index, _, _, _ in actual], [0, 1, 2, 3, 4])
+
+    def test_pruning(self):
+        actual = list(flamegraph.iter_visible_frames(self.make_tree(), 5))
+        self.assertEqual(actual, [(0, 0, 0, 100), (1, 0, 1, 90)])
+
+    def test_merging(self):
+        actual = list(flamegraph.iter_visible_frames(self.make_tree(), 5, merge_narrow_frames=True))
+        self.assertEqual(actual, [(0, 0, 0, 100), (1, 0, 1, 90), (-1, 90, 1, 7)])
+
+    def test_merged_frames_too_narrow(self):
+        actual = list(flamegraph.iter_visible_frames(self.make_tree(), 8, merge_narrow_frames=True))
+        self.assertEqual(actual, [(0, 0, 0, 100), (1, 0, 1, 90)])
+
+
+class RenderingTestCase(unittest.TestCase):
+    def thread_sections(self):
+        parser = flamegraph.TraceReportParser(REPORT_LINES)
+        return [section for section in parser.iter_process_sections()
+                if flamegraph.is_thread_section(section)]
+
+    def test_render_thread_trace(self):
+        settings = flamegraph.FlameGraphSettings(total_width=900)
+        svg = flamegraph.render_thread_trace(flamegraph.ThreadTrace(THREAD_LINES), settings)
+        self.assertEqual((svg.width, svg.height), (900, 64.))
+        rects = [line for line in svg.content_lines if line.startswith("<rect")]
+        self.assertEqual(len(rects), 5)
+        self.assertTrue(rects[0].startswith('<rect x="0.0" y="48.0" width="900.0" height="15.0"'))
+
+    def test_render_empty_thread_trace(self):
+        settings = flamegraph.FlameGraphSettings()
+        svg = flamegraph.render_thread_trace(flamegraph.ThreadTrace.from_folded([], "empty"), settings)
+        self.assertEqual(svg.content_lines, [])
+
+    def test_min_frame_width(self):
+        settings = flamegraph.FlameGraphSettings(total_width=90)
+        settings.min_frame_width = 35.
+        svg = flamegraph.render_thread_trace(flamegraph.ThreadTrace(THREAD_LINES), settings)
+        rects = [line for line in svg.content_lines if line.startswith("<rect")]
+        self.assertEqual(len(rects), 3)
+
+    def test_color_lookup_table(self):
+        settings = flamegraph.FlameGraphSettings()
+        settings.color_lookup_steps = 256
+        svg = flamegraph.render_thread_trace(flamegraph.ThreadTrace(THREAD_LINES), settings)
+        self.assertTrue(svg.content_lines[0].startswith('<style type="text/css">.c'))
+        rects = [line for line in svg.content_lines if line.startswith("<rect")]
+        self.assertTrue(all(' class="c' in rect for rect in rects))
+
+    def test_jobs_must_be_positive(self):
+        with self.assertRaises(SystemExit):
+            flamegraph.parse_arguments(["--all-threads", "--jobs", "0", "a.hang"])
+        self.assertEqual(flamegraph.parse_arguments(["--all-threads", "--jobs", "1", "a.hang"]).jobs, 1)
+
+    def test_parallel_rendering(self):
+        settings = flamegraph.FlameGraphSettings()
+        serial = list(flamegraph.render_thread_sections(self.thread_sections(), settings, jobs=1))
+        parallel = list(flamegraph.render_thread_sections(self.thread_sections(), settings, jobs=2))
+        self.assertEqual([description for description, _ in parallel],
+                         ["Thread 0x1a2b3     DispatchQueue 1     9 samples (1-9)",
+                          "Thread 0x1a2b4     5 samples (1-5)"])
+        self.assertEqual([svg.content_lines for _, svg in serial],
+                         [svg.content_lines for _, svg in parallel])
+
+    def test_stacked_threads(self):
+        settings = flamegraph.FlameGraphSettings()
+        rendered_threads = flamegraph.render_thread_sections(self.thread_sections(), settings, jobs=1)
+        svg = flamegraph.stack_thread_svgs(rendered_threads, settings)
+        self.assertEqual(svg.height, 24. + 64. + 24. + 32.)
+        groups = [line for line in svg.content_lines if line.startswith("<g")]
+        self.assertEqual(groups, ['<g transform="translate(0,24.0)">', '<g transform="translate(0,112.0)">'])
+
+
+class TextFitterTestCase(unittest.TestCase):
+    def test_glyph_widths(self):
+        text_fitter = flamegraph.TextFitter()
+        self.assertAlmostEqual(text_fitter.text_width("Mi"), (833 + 222) * 12 / 1000.)
+        self.assertAlmostEqual(text_fitter.text_width("\u2026"), 556 * 12 / 1000.)
+        self.assertAlmostEqual(text_fitter.ellipsis_width, 12.)
+        self.assertEqual(text_fitter.prefix_widths("ab"), [0., 6.672, 13.344])
+
+    def test_fit(self):
+        text_fitter = flamegraph.TextFitter()
+        self.assertEqual(text_fitter.fit("iiii", 20.), "iiii")
+        # "M" is 10 pixels wide, ellipsis is 12 pixels wide.
+        self.assertEqual(text_fitter.fit("MMMM", 32.), "MM\u2026")
+        self.assertEqual(text_fitter.fit("MMMM", 31.9), "M\u2026")
+        self.assertIsNone(text_fitter.fit("MMMM", 21.))
+
+    def test_memoized_by_id(self):
+        text_fitter = flamegraph.TextFitter()
+        self.assertEqual(text_fitter.fit("MMMM", 32.5, 7), "MM\u2026")
+        # Same id and width bucket return memoized result.
+        self.assertEqual(text_fitter.fit("other text", 32.9, 7), "MM\u2026")
+        self.assertEqual(text_fitter.fit("other text", 32.9, 8), "oth\u2026")
+
+    def test_add_bounded_text(self):
+        svg = flamegraph.SVG(100, 100)
+        svg.add_bounded_text("MMMM", 1., 2., 32.)
+        svg.add_bounded_text("MMMM", 1., 2., 10.)
+        self.assertEqual(len(svg.content_lines), 1)
+        self.assertTrue(svg.content_lines[0].endswith(">MM\u2026</text>"))
+
+
+class StreamingSVGTestCase(TemporaryDirectoryTestCase):
+    def test_same_output_as_svg(self):
+        svg = flamegraph.SVG(100, 100)
+        string_buffer = io.StringIO()
+        streaming_svg = flamegraph.StreamingSVG(string_buffer, 100, 100)
+        for each_svg in (svg, streaming_svg):
+            each_svg.add_rect(23.23, 76.76, 45, 54, 'rgb(100,100,100)')
+            each_svg.add_text("int const&", 12.34, 56.78)
+        streaming_svg.close()
+        expected_buffer = io.StringIO()
+        svg.dump(expected_buffer)
+        self.assertEqual(string_buffer.getvalue(), expected_buffer.getvalue())
+        self.assertEqual(streaming_svg.content_lines, [])
+
+    def test_elements_are_written_immediately(self):
+        string_buffer = io.StringIO()
+        svg = flamegraph.StreamingSVG(string_buffer, 45, 62)
+        self.assertTrue(string_buffer.getvalue().endswith('xmlns="http://www.w3.org/2000/svg">\n'))
+        svg.add_text("foo", 12.34, 56.78)
+        self.assertTrue(string_buffer.getvalue().endswith('>foo</text>\n'))
+
+    def test_write_thread_sections(self):
+        parser = flamegraph.TraceReportParser(REPORT_LINES)
+        thread_sections = [section for section in parser.iter_process_sections()
+                           if flamegraph.is_thread_section(section)]
+        # The directory doesn't exist yet.
+        output_dir = os.path.join(self.directory, "threads")
+        paths = list(flamegraph.write_thread_sections(thread_sections, flamegraph.FlameGraphSettings(), output_dir,
+                                                      jobs=2))
+        self.assertEqual(sorted(os.listdir(output_dir)), ["thread-000.svg", "thread-001.svg"])
+        self.assertEqual([os.path.basename(path) for path in paths], ["thread-000.svg", "thread-001.svg"])
+        with io.open(paths[1], "rt", encoding="utf-8") as svg_file:
+            self.assertTrue(svg_file.read().endswith("</text>\n</svg>"))
+
+
+class CompressionTestCase(TemporaryDirectoryTestCase):
+    def test_compressed_reports(self):
+        report_bytes = "\n".join(REPORT_LINES).encode("utf-8")
+        for extension, compressor in flamegraph._DECOMPRESSORS.items():
+            path = os.path.join(self.directory, "a.hang" + extension)
+            compressed_file = compressor(path, "wb")
+            compressed_file.write(report_bytes)
+            compressed_file.close()
+            self.assertTrue(flamegraph.is_compressed(path))
+            report = flamegraph.TraceReport.from_file(path)
+            self.assertEqual([thread.root_frame.sample_count for thread in report.process_trace.threads], [9, 5])
+
+    def test_svgz_output(self):
+        path = os.path.join(self.directory, "thread.svgz")
+        with flamegraph.open_output_stream(path) as stream:
+            flamegraph.write_thread_trace(stream, flamegraph.ThreadTrace(THREAD_LINES), flamegraph.FlameGraphSettings())
+        with gzip.open(path, "rb") as svg_file:
+            svg = svg_file.read().decode("utf-8")
+        self.assertTrue(svg.startswith("<svg"))
+        self.assertTrue(svg.endswith("</svg>"))
+        self.assertIn("baz + 7", svg)
+
+    def test_write_thread_sections(self):
+        parser = flamegraph.TraceReportParser(REPORT_LINES)
+        paths = list(flamegraph.write_thread_sections(parser.iter_thread_traces(), flamegraph.FlameGraphSettings(),
+                                                      self.directory, jobs=1, compress=True))
+        self.assertEqual([os.path.basename(path) for path in paths], ["thread-000.svgz", "thread-001.svgz"])
+        with gzip.open(paths[1], "rb") as svg_file:
+            self.assertIn(b"mach_msg_trap", svg_file.read())
+
+
+class ServerTestCase(TemporaryDirectoryTestCase):
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.report_path = self.write_report("a.hang")
+        self.report_cache = flamegraph.ReportCache()
+        self.server = flamegraph.RenderServer(("127.0.0.1", 0), self.directory, flamegraph.FlameGraphSettings(),
+                                              self.report_cache, threads=2)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server_thread.join()
+        self.server.server_close()
+        TemporaryDirectoryTestCase.tearDown(self)
+
+    def get(self, path):
+        response = urlopen("http://127.0.0.1:%d%s" % (self.server.server_address[1], path))
+        try:
+            return response.read().decode("utf-8")
+        finally:
+            response.close()
+
+    def assertStatus(self, path, status):
+        with self.assertRaises(HTTPError) as context:
+            self.get(path)
+        self.assertEqual(context.exception.code, status)
+
+    def test_render(self):
+        svg = self.get("/a.hang?thread=1&width=300")
+        self.assertTrue(svg.startswith('<svg width="300" height="32.0"'))
+        self.assertTrue(svg.endswith("</svg>"))
+        self.assertIn("mach_msg_trap", svg)
+        # The second request is served from memory.
+        report = self.report_cache.get(self.report_path)
+        self.assertEqual(self.get("/a.hang?thread=1&width=300"), svg)
+        self.assertIs(self.report_cache.get(self.report_path), report)
+
+    def test_gzip_encoding(self):
+        request = Request("http://127.0.0.1:%d/a.hang" % self.server.server_address[1],
+                          headers={"Accept-Encoding": "gzip"})
+        response = urlopen(request)
+        try:
+            self.assertEqual(response.headers["Content-Encoding"], "gzip")
+            svg = gzip.GzipFile(fileobj=io.BytesIO(response.read())).read().decode("utf-8")
+        finally:
+            response.close()
+        self.assertEqual(svg, self.get("/a.hang"))
+
+    def test_zoom(self):
+        svg = self.get("/a.hang?zoom=" + quote("main + 34 (Xcode) [0x10d19ae72];bar + 5 (Foo) [0x10d19b002]"))
+        self.assertIn(">bar + 5", svg)
+        self.assertIn(">baz + 7", svg)
+        self.assertNotIn("main + 34", svg)
+        self.assertStatus("/a.hang?zoom=missing", 404)
+
+    def test_errors(self):
+        self.assertStatus("/missing.hang", 404)
+        self.assertStatus("/a.hang?thread=5", 404)
+        self.assertStatus("/a.hang?width=wide", 400)
+        self.assertStatus("/../a.hang", 403)
+        self.assertStatus("/%2e%2e/a.hang", 403)
+
+    def test_unparseable_reports(self):
+        self.write_report("README", ["Hang reports of the nightly run", ""])
+        with io.open(os.path.join(self.directory, "bad.hang.gz"), "wb") as compressed_file:
+            compressed_file.write(b"not gzip")
+        self.assertStatus("/README", 422)
+        self.assertStatus("/bad.hang.gz", 422)
+
+    def test_report_cache_eviction(self):
+        other_path = os.path.join(self.directory, "b.hang")
+        shutil.copy(self.report_path, other_path)
+        report_size = flamegraph.report_memory_size(self.report_cache.get(self.report_path))
+        report_cache = flamegraph.ReportCache(max_bytes=report_size * 3 // 2)
+        report = report_cache.get(self.report_path)
+        self.assertIs(report_cache.get(self.report_path), report)
+        report_cache.get(other_path)
+        self.assertEqual(report_cache.size, report_size)
+        self.assertIsNot(report_cache.get(self.report_path), report)
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def test_stages(self):
+        instrumentation = flamegraph.Instrumentation()
+        finished_stages = []
+        instrumentation.add_callback(lambda name, seconds, counts: finished_stages.append((name, counts)))
+        previous_instrumentation = flamegraph.set_instrumentation(instrumentation)
+        try:
+            report = flamegraph.TraceReport(REPORT_LINES)
+            flamegraph.render_thread_trace(report.process_trace.threads[0], flamegraph.FlameGraphSettings())
+        finally:
+            flamegraph.set_instrumentation(previous_instrumentation)
+        self.assertEqual(list(instrumentation.stages),
+                         ["split_sections", "parse_thread", "layout", "color", "svg"])
+        self.assertEqual(instrumentation.stages["parse_thread"]["calls"], 2)
+        self.assertEqual(instrumentation.stages["parse_thread"]["counts"], {"nodes": 7})
+        self.assertEqual(instrumentation.stages["svg"]["counts"], {"rects": 5})
+        self.assertIn(("layout", {"nodes": 5, "visible_frames": 5}), finished_stages)
+        string_buffer = io.StringIO()
+        instrumentation.write_json(string_buffer)
+        self.assertIn('"split_sections"', string_buffer.getvalue())
+
+    def test_disabled_by_default(self):
+        previous_instrumentation = flamegraph.set_instrumentation(flamegraph.NullInstrumentation())
+        flamegraph.set_instrumentation(previous_instrumentation)
+        self.assertIsInstance(previous_instrumentation, flamegraph.NullInstrumentation)
+
+
+class BenchmarkTestCase(TemporaryDirectoryTestCase):
+    def test_generated_report(self):
+        string_buffer = io.StringIO()
+        benchmark_flamegraph.generate_spindump(string_buffer, 400, thread_count=4, fan_out=3)
+        report = flamegraph.TraceReport(string_buffer.getvalue().splitlines())
+        threads = report.process_trace.threads
+        self.assertEqual(len(threads), 4)
+        self.assertEqual([len(thread.frame_tree) for thread in threads], [100] * 4)
+
+    def test_max_depth(self):
+        string_buffer = io.StringIO()
+        benchmark_flamegraph.generate_spindump(string_buffer, 400, thread_count=4, max_depth=5, fan_out=3)
+        report = flamegraph.TraceReport(string_buffer.getvalue().splitlines())
+        self.assertTrue(all(thread.max_stack_depth() <= 5 for thread in report.process_trace.threads))
+
+    def test_run_benchmark(self):
+        path = os.path.join(self.directory, "synthetic.spin")
+        with io.open(path, "wt") as report_file:
+            benchmark_flamegraph.generate_spindump(report_file, 50, thread_count=2)
+        result = benchmark_flamegraph.run_benchmark(path, 50, flamegraph.FlameGraphSettings())
+        self.assertEqual(result["nodes"], 50)
+        self.assertEqual(sorted(result["phases"]), ["color", "layout", "parse", "render", "svg"])
+        self.assertEqual(result["phases"]["parse"]["lines"], 50)
+
+
 if __name__ == '__main__':
     unittest.main()